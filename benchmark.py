@@ -0,0 +1,276 @@
+"""
+Нагрузочный тест API.
+
+Создает отдельную базу, наполняет ее заданным числом монеток, запускает
+приложение через uvicorn и с фиксированной конкурентностью отправляет
+смешанный поток запросов. Пропускная способность и p50/p95/p99 по каждому
+эндпоинту печатаются и сохраняются в JSON для сравнения запусков.
+
+    python benchmark.py --coins 100000 --concurrency 20 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy.engine import make_url
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+import models
+from database import SQLALCHEMY_DATABASE_URL, SQLALCHEMY_ASYNC_DATABASE_URL
+from fake_data_db_test.generate import generate
+
+DICTIONARIES = {
+    'type': models.Type,
+    'currency': models.Currency,
+    'md': models.Md,
+    'state': models.State,
+}
+DEFAULT_MIX = 'list=50,dictionary=25,create=10,update=10,login=5'
+PASSWORD = 'benchmark'
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, weight = item.split('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Unknown scenario {name}')
+        mix[name] = float(weight)
+    return mix
+
+
+def seed_database(url, async_url, args):
+    """Пересоздание базы и наполнение ее справочниками и монетками"""
+    if database_exists(url):
+        drop_database(url)
+    create_database(url)
+    asyncio.run(generate(async_url, args.coins, args.users,
+                         args.dictionary_size, args.skew, seed=args.seed,
+                         password=PASSWORD, skip_fk_checks=True))
+
+
+def random_coin(rng, dictionary_size):
+    return {
+        'description': f'монета {rng.randint(1, 10 ** 6)}',
+        'type_id': rng.randint(1, dictionary_size),
+        'currency_id': rng.randint(1, dictionary_size),
+        'nominal_value': str(rng.choice((1, 5, 10, 50, 100))),
+        'md_id': rng.randint(1, dictionary_size),
+        'state_id': rng.randint(1, dictionary_size),
+        'year': str(rng.randint(1700, 2023)),
+        'serial_number': str(rng.randint(1, 10 ** 6)),
+    }
+
+
+class Worker:
+    """Клиент с собственной сессией (cookies) и созданными монетками"""
+
+    def __init__(self, client, rng, username, dictionary_size):
+        self.client = client
+        self.rng = rng
+        self.username = username
+        self.dictionary_size = dictionary_size
+        self.coin_ids = []
+
+
+async def login(worker):
+    return await worker.client.post('/api/user/login', json={
+        'username': worker.username, 'password': PASSWORD})
+
+
+async def list_coins(worker):
+    return await worker.client.get('/api/coins/')
+
+
+async def read_dictionary(worker):
+    name = worker.rng.choice(list(DICTIONARIES))
+    return await worker.client.get(f'/api/dictionary/{name}')
+
+
+async def create_coin(worker):
+    response = await worker.client.post(
+        '/api/coins/', json=random_coin(worker.rng, worker.dictionary_size))
+    if response.status_code == 201:
+        worker.coin_ids.append(response.json()['id'])
+    return response
+
+
+async def update_coin(worker):
+    coin_id = worker.rng.choice(worker.coin_ids)
+    return await worker.client.put(
+        f'/api/coins/{coin_id}',
+        json=random_coin(worker.rng, worker.dictionary_size))
+
+
+SCENARIOS = {
+    'login': ('POST /api/user/login', login),
+    'list': ('GET /api/coins', list_coins),
+    'dictionary': ('GET /api/dictionary/{name}', read_dictionary),
+    'create': ('POST /api/coins', create_coin),
+    'update': ('PUT /api/coins/{id}', update_coin),
+}
+
+
+async def run_worker(worker, mix, deadline, results):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    await login(worker)
+    while time.perf_counter() < deadline:
+        name = worker.rng.choices(names, weights)[0]
+        if name == 'update' and not worker.coin_ids:
+            name = 'create'
+        endpoint, scenario = SCENARIOS[name]
+        started = time.perf_counter()
+        try:
+            response = await scenario(worker)
+            ok = response.is_success
+        except httpx.HTTPError:
+            ok = False
+        item = results.setdefault(endpoint, {'latencies': [], 'errors': 0})
+        item['latencies'].append(time.perf_counter() - started)
+        if not ok:
+            item['errors'] += 1
+
+
+async def run_load(base_url, args):
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    deadline = time.perf_counter() + args.duration
+    clients = [httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=args.timeout)
+               for _ in range(args.concurrency)]
+    workers = [
+        Worker(client, random.Random(args.seed + index),
+               f'user{index % args.users}', args.dictionary_size)
+        for index, client in enumerate(clients)]
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_worker(worker, args.mix, deadline, results)
+                               for worker in workers))
+    finally:
+        for client in clients:
+            await client.aclose()
+    return results, time.perf_counter() - started
+
+
+def percentile(latencies, value):
+    """Перцентиль по ближайшему рангу, latencies отсортирован"""
+    index = max(0, int(round(value / 100 * len(latencies))) - 1)
+    return latencies[min(index, len(latencies) - 1)]
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for endpoint, item in sorted(results.items()):
+        latencies = sorted(item['latencies'])
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': item['errors'],
+            'throughput': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f'{"endpoint":30} {"requests":>9} {"errors":>7} {"rps":>9} '
+          f'{"p50":>9} {"p95":>9} {"p99":>9}')
+    for endpoint, item in summary.items():
+        print(f'{endpoint:30} {item["requests"]:>9} {item["errors"]:>7} '
+              f'{item["throughput"]:>9} {item["p50_ms"]:>9} '
+              f'{item["p95_ms"]:>9} {item["p99_ms"]:>9}')
+
+
+def start_server(database, port, workers):
+    env = dict(os.environ, POSTGRES_DB=database)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning'], env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(600):
+        if server.poll() is not None:
+            raise RuntimeError('Server exited during startup')
+        try:
+            httpx.get(base_url + '/')
+            return server, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('Server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--coins', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--dictionary-size', type=int, default=20)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of coins per user')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of load')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f'scenario weights, default {DEFAULT_MIX}')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', default='coins_benchmark')
+    parser.add_argument('--skip-seed', action='store_true',
+                        help='reuse the database from a previous run')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--server-workers', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seed_database(
+            make_url(SQLALCHEMY_DATABASE_URL).set(database=args.database),
+            make_url(SQLALCHEMY_ASYNC_DATABASE_URL).set(
+                database=args.database),
+            args)
+        print(f'Seeded {args.coins} coins in '
+              f'{time.perf_counter() - started:.1f}s')
+    server, base_url = start_server(args.database, args.port,
+                                    args.server_workers)
+    try:
+        results, elapsed = asyncio.run(run_load(base_url, args))
+    finally:
+        server.terminate()
+        server.wait()
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    with open(args.output, 'w', encoding='UTF-8') as file:
+        json.dump({
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {
+                'coins': args.coins,
+                'users': args.users,
+                'dictionary_size': args.dictionary_size,
+                'skew': args.skew,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'mix': args.mix,
+                'seed': args.seed,
+                'server_workers': args.server_workers,
+            },
+            'elapsed': round(elapsed, 3),
+            'total_throughput': round(
+                sum(item['requests'] for item in summary.values()) / elapsed,
+                2),
+            'endpoints': summary,
+        }, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
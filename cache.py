@@ -0,0 +1,392 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, NamedTuple
+
+import orjson
+
+from config import settings
+
+
+class Codec(NamedTuple):
+    """
+    Преобразование значений для общих хранилищ. Только данные: значение из
+    файла или Redis не может выполнить код при чтении, как pickle
+    """
+    dumps: Callable
+    loads: Callable
+
+
+JSON_CODEC = Codec(orjson.dumps, orjson.loads)
+# Готовые тела ответов хранятся как есть
+BYTES_CODEC = Codec(bytes, bytes)
+
+
+class TTLCache:
+    """
+    LRU-кэш в памяти процесса с ограниченным временем жизни записей.
+    maxbytes ограничивает суммарный размер значений (len) - для кэшей
+    готовых тел ответов, размер которых заранее неизвестен
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60,
+                 maxbytes: int | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at, _ = item
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(value) if self.maxbytes is not None else 0
+        with self._lock:
+            self._pop(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl, size)
+            self.size += size
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes is not None and self.size > self.maxbytes):
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class MemoryCache:
+    """Кэш в памяти процесса с тем же асинхронным интерфейсом, что у общих"""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60,
+                 maxbytes: int | None = None):
+        self.cache = TTLCache(maxsize, ttl, maxbytes)
+
+    async def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    async def set(self, key, value):
+        self.cache.set(key, value)
+
+    async def delete(self, key):
+        self.cache.delete(key)
+
+    async def clear(self):
+        self.cache.clear()
+
+
+class SQLiteCache:
+    """
+    Кэш в файле SQLite, общий для всех процессов на одной машине:
+    удаление записи сразу видно остальным процессам. Запросы к файлу
+    выполняются в потоках, чтобы не останавливать цикл событий
+    """
+    PRUNE_EVERY = 100
+
+    def __init__(self, path: str, namespace: str, maxsize: int = 128,
+                 ttl: float = 60, codec: Codec = JSON_CODEC):
+        self.path = path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.codec = codec
+        self._local = threading.local()
+        self._sets = 0
+
+    def _connection(self):
+        # Соединение sqlite3 нельзя использовать из другого потока
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            open_private_file(self.path)
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, "
+                "value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))")
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key, default):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? "
+            "AND expires_at > ?",
+            (self.namespace, repr(key), time.time())).fetchone()
+        return default if row is None else self.codec.loads(row[0])
+
+    def _set(self, key, value):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (self.namespace, repr(key), self.codec.dumps(value),
+             time.time() + self.ttl))
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            self._prune(connection)
+
+    def _prune(self, connection):
+        """Удаление просроченных записей и самых старых сверх maxsize"""
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND (expires_at <= ? OR "
+            "key NOT IN (SELECT key FROM cache WHERE namespace = ? "
+            "ORDER BY expires_at DESC LIMIT ?))",
+            (self.namespace, time.time(), self.namespace, self.maxsize))
+
+    def _delete(self, key):
+        self._connection().execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ?",
+            (self.namespace, repr(key)))
+
+    def _clear(self):
+        self._connection().execute(
+            "DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    async def get(self, key, default=None):
+        return await asyncio.to_thread(self._get, key, default)
+
+    async def set(self, key, value):
+        await asyncio.to_thread(self._set, key, value)
+
+    async def delete(self, key):
+        await asyncio.to_thread(self._delete, key)
+
+    async def clear(self):
+        await asyncio.to_thread(self._clear)
+
+
+class RedisCache:
+    """
+    Кэш в Redis (клиент redis.asyncio) с локальной копией записей в памяти
+    процесса (local_ttl). Удаление записи рассылается через pub/sub, и
+    каждый процесс сбрасывает свою локальную копию
+    """
+    CHANNEL = 'cache-invalidation'
+
+    def __init__(self, client, namespace: str, maxsize: int = 128,
+                 ttl: float = 60, local_ttl: float = 0,
+                 codec: Codec = JSON_CODEC, maxbytes: int | None = None):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+        self.codec = codec
+        self.local = (TTLCache(maxsize, local_ttl, maxbytes)
+                      if local_ttl else None)
+        self._subscribed = False
+
+    def _key(self, key):
+        return f'cache:{self.namespace}:{key!r}'
+
+    async def _local(self):
+        # Локальной копией можно пользоваться только после подписки на
+        # рассылку удалений
+        if self.local is not None and not self._subscribed:
+            await RedisInvalidation.subscribe(self)
+            self._subscribed = True
+        return self.local
+
+    async def get(self, key, default=None):
+        local = await self._local()
+        if local is not None:
+            value = local.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        data = await self.client.get(self._key(key))
+        if data is None:
+            return default
+        value = self.codec.loads(data)
+        if local is not None:
+            local.set(key, value)
+        return value
+
+    async def set(self, key, value):
+        await self.client.set(self._key(key), self.codec.dumps(value),
+                              px=int(self.ttl * 1000))
+        local = await self._local()
+        if local is not None:
+            local.set(key, value)
+
+    async def delete(self, key):
+        await self.client.delete(self._key(key))
+        await self._invalidate(key)
+
+    async def clear(self):
+        keys = [key async for key in self.client.scan_iter(
+            match=f'cache:{self.namespace}:*')]
+        if keys:
+            await self.client.delete(*keys)
+        await self._invalidate(None)
+
+    async def _invalidate(self, key):
+        if self.local is None:
+            return
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.delete(key)
+        await self.client.publish(self.CHANNEL,
+                                  orjson.dumps([self.namespace, key]))
+
+
+_MISSING = object()
+
+
+class RedisInvalidation:
+    """Подписка процесса на рассылку удалений из кэшей в Redis"""
+    _instances = {}
+    _lock = asyncio.Lock()
+
+    def __init__(self, client, pubsub):
+        self.client = client
+        self.caches = {}
+        self.task = asyncio.get_running_loop().create_task(
+            self.listen(pubsub))
+
+    @classmethod
+    async def subscribe(cls, cache: RedisCache):
+        async with cls._lock:
+            listener = cls._instances.get(id(cache.client))
+            if listener is None:
+                # Ошибка подписки достается запросу, а не фоновой задаче
+                pubsub = await cls.connect(cache.client)
+                listener = cls(cache.client, pubsub)
+                cls._instances[id(cache.client)] = listener
+        listener.caches[cache.namespace] = cache
+
+    @staticmethod
+    async def connect(client):
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(RedisCache.CHANNEL)
+        return pubsub
+
+    async def listen(self, pubsub):
+        from redis.exceptions import RedisError
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = await self.connect(self.client)
+                async for message in pubsub.listen():
+                    self.handle(message)
+            except (OSError, RedisError):
+                # Пока подписки нет, удаления могли потеряться
+                for cache in self.caches.values():
+                    cache.local.clear()
+                pubsub = None
+                await asyncio.sleep(1)
+
+    def handle(self, message):
+        try:
+            namespace, key = orjson.loads(message['data'])
+        except ValueError:
+            # Чужое сообщение в канале не останавливает подписку
+            return
+        cache = self.caches.get(namespace)
+        if cache is None:
+            return
+        if key is None:
+            cache.local.clear()
+        else:
+            cache.local.delete(key)
+
+
+class LazyCache:
+    """
+    Кэш, хранилище которого создается при первом обращении: импорт модулей
+    не открывает файлов и соединений
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = self.factory()
+        return self._backend
+
+    async def get(self, key, default=None):
+        return await self.backend.get(key, default)
+
+    async def set(self, key, value):
+        await self.backend.set(key, value)
+
+    async def delete(self, key):
+        await self.backend.delete(key)
+
+    async def clear(self):
+        await self.backend.clear()
+
+
+def open_private_file(path: str):
+    """
+    Файл кэша создается доступным только пользователю процесса; файл,
+    который может изменить кто-то еще, не используется
+    """
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT |
+                         getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        info = os.fstat(descriptor)
+    finally:
+        os.close(descriptor)
+    if info.st_mode & 0o022 or (hasattr(os, 'geteuid')
+                                and info.st_uid != os.geteuid()):
+        raise PermissionError(
+            f'Cache file {path} must be owned by the application user and '
+            f'not writable by others')
+
+
+@lru_cache
+def get_redis():
+    import redis.asyncio
+    return redis.asyncio.Redis.from_url(settings.CACHE_URL)
+
+
+def build_cache(namespace: str, maxsize: int, ttl: float, codec: Codec,
+                maxbytes: int | None):
+    if settings.CACHE_BACKEND == 'sqlite':
+        return SQLiteCache(settings.CACHE_URL, namespace, maxsize, ttl,
+                           codec)
+    if settings.CACHE_BACKEND == 'redis':
+        return RedisCache(get_redis(), namespace, maxsize, ttl,
+                          settings.CACHE_LOCAL_TTL, codec, maxbytes)
+    return MemoryCache(maxsize, ttl, maxbytes)
+
+
+def create_cache(namespace: str, maxsize: int, ttl: float,
+                 codec: Codec = JSON_CODEC, maxbytes: int | None = None):
+    """
+    Кэш с хранилищем из настроек CACHE_BACKEND: memory - в памяти
+    процесса, sqlite - файл CACHE_URL, redis - сервер CACHE_URL. В общих
+    хранилищах значения записываются через codec; maxbytes ограничивает
+    размер копий в памяти процесса. Хранилище создается при первом
+    обращении к кэшу
+    """
+    return LazyCache(
+        lambda: build_cache(namespace, maxsize, ttl, codec, maxbytes))
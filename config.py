@@ -1,4 +1,4 @@
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 
 
 class Settings(BaseSettings):
@@ -17,6 +17,63 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRES_IN: int
     JWT_ALGORITHM: str
 
+    # Создание базы, таблиц и индексов при запуске приложения
+    DB_INIT_ON_STARTUP: bool = True
+    DB_INIT_ATTEMPTS: int = 5
+    DB_INIT_RETRY_DELAY: float = 1
+
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE: int = 1800
+    # По умолчанию равен числу соединений, которое может выдать пул
+    THREADPOOL_SIZE: int | None = None
+
+    # Middleware с метриками и эндпоинт /metrics
+    METRICS_ENABLED: bool = False
+
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 64
+
+    COINS_PAGE_SIZE: int = 50
+    COINS_PAGE_SIZE_MAX: int = 500
+    COINS_BATCH_SIZE_MAX: int = 500
+    COINS_EXPORT_CHUNK_SIZE: int = 1000
+    COINS_IMPORT_CHUNK_SIZE: int = 1000
+    COINS_IMPORT_MAX_ERRORS: int = 1000
+
+    # Хранилище кэшей: memory, sqlite (файл CACHE_URL в каталоге
+    # приложения) или redis (адрес CACHE_URL); кэши memory у каждого
+    # воркера uvicorn свои
+    CACHE_BACKEND: str = 'memory'
+    CACHE_URL: str | None = None
+    # Сколько секунд воркер держит копию записи из Redis у себя
+    CACHE_LOCAL_TTL: float = 5
+
+    # Страницы списка монеток в кэше: не больше COINS_CACHE_SIZE штук и
+    # COINS_CACHE_MAX_BYTES байт в памяти каждого воркера (страница из
+    # 500 монеток занимает около 150 КБ)
+    COINS_CACHE_SIZE: int = 1000
+    COINS_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    COINS_CACHE_TTL: int = 60
+    DICTIONARY_CACHE_TTL: int = 300
+    PRINCIPAL_CACHE_TTL: int = 30
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    # Проверенные токены; запись в любом случае живет не дольше exp
+    JWT_CLAIMS_CACHE_SIZE: int = 10000
+    JWT_CLAIMS_CACHE_TTL: int = 900
+    # Как часто воркер подгружает токены, отозванные другими воркерами
+    TOKEN_DENYLIST_SYNC_INTERVAL: float = 5
+
+    @validator('CACHE_URL', always=True)
+    def cache_url_required(cls, value, values):
+        if values.get('CACHE_BACKEND') in ('sqlite', 'redis') and not value:
+            raise ValueError(f'CACHE_URL is required for CACHE_BACKEND='
+                             f'{values.get("CACHE_BACKEND")}')
+        return value
+
     class Config:
         env_file = '.env'
 
@@ -1,26 +1,67 @@
+from functools import lru_cache
+
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database
 
 from config import settings
+from pool_stats import TimedAsyncAdaptedQueuePool
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOSTNAME}:{settings.DATABASE_PORT}/{settings.POSTGRES_DB}"
+SQLALCHEMY_ASYNC_DATABASE_URL = f"postgresql+asyncpg://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOSTNAME}:{settings.DATABASE_PORT}/{settings.POSTGRES_DB}"
+
+
+# Движки создаются при первом обращении, поэтому импорт модуля не
+# обращается к базе. Синхронный: создание схемы и служебные скрипты
+@lru_cache
+def get_engine():
+    return create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+
+
+# Асинхронный движок (asyncpg): обработчики запросов API
+@lru_cache
+def get_async_engine():
+    return create_async_engine(
+        SQLALCHEMY_ASYNC_DATABASE_URL,
+        poolclass=TimedAsyncAdaptedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+
+
+def create_database_if_missing():
+    engine = get_engine()
+    if not database_exists(engine.url):
+        try:
+            create_database(engine.url)
+        except DBAPIError:
+            # Ее мог одновременно создать другой воркер
+            if not database_exists(engine.url):
+                raise
+
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
-if not database_exists(engine.url):
-    create_database(engine.url)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = sessionmaker(class_=AsyncSession,
+                                 autocommit=False, autoflush=False,
+                                 expire_on_commit=False)
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
+async def get_db():
+    db = AsyncSessionLocal(bind=get_async_engine())
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
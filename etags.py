@@ -0,0 +1,53 @@
+import hashlib
+
+from fastapi import Request, Response, status
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from oauth2 import Principal
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix('W/') for tag in header.split(',')}
+    return etag in tags or '*' in tags
+
+
+def not_modified(etag: str):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                    headers={'ETag': etag})
+
+
+# Версии читаются до данных: если запись попадет между двумя запросами,
+# клиент получит новые данные со старой версией и просто перезапросит
+# их, а не закэширует старые данные с новой версией
+async def read_versions(db: AsyncSession, *conditions):
+    result = await db.execute(
+        select(models.CollectionVersion.collection,
+               models.CollectionVersion.part,
+               models.CollectionVersion.version).where(or_(*conditions)))
+    return sorted(result.all())
+
+
+async def coins_versions(db: AsyncSession, user: Principal):
+    """Версии монеток, видимых пользователю, и справочников в них"""
+    version = models.CollectionVersion
+    if user.is_superuser:
+        coins = version.collection == 'coins_all'
+    else:
+        coins = and_(version.collection == 'coins', version.part == user.id)
+    return await read_versions(
+        db, coins, version.collection.in_(models.DICTIONARY_TABLES))
+
+
+async def dictionary_version(db: AsyncSession, table: str):
+    return await read_versions(
+        db, models.CollectionVersion.collection == table)
@@ -0,0 +1,210 @@
+"""
+Генератор больших тестовых баз.
+
+Строки генерируются потоком и детерминированно (зависят только от --seed),
+монетки вставляются пачками через COPY в PostgreSQL и executemany в
+остальных базах, поэтому память не растет с числом строк. Владельцы
+монеток распределены по закону Ципфа: при --skew 1 несколько первых
+пользователей владеют большей частью монеток, при --skew 0 поровну.
+С --skip-fk-checks суперпользователь PostgreSQL вставляет монетки без
+построчной проверки внешних ключей.
+
+    python -m fake_data_db_test.generate --coins 10000000 --users 100000
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+import models
+from database import Base, SQLALCHEMY_ASYNC_DATABASE_URL
+from importer import insert_coins
+from passwords import pwd_context
+
+DICTIONARIES = (models.Type, models.Currency, models.Md, models.State)
+WORDS = ('золотая', 'серебряная', 'медная', 'юбилейная', 'памятная',
+         'редкая', 'монета', 'рубль', 'копейка', 'талер', 'дукат', 'пробная')
+NOMINAL_VALUES = ('1', '2', '5', '10', '20', '50', '100', '1000')
+
+
+def zipf_cum_weights(count: int, skew: float):
+    """Накопленные веса распределения Ципфа для random.choices"""
+    return list(itertools.accumulate(
+        1 / (rank ** skew) for rank in range(1, count + 1)))
+
+
+def iter_coin_batches(count, user_ids, dictionary_ids, skew=1.0,
+                      dictionary_skew=0.0, seed=0, batch_size=10000):
+    """Пачки строк монеток, одинаковые при одинаковых параметрах"""
+    rng = random.Random(seed)
+    user_weights = zipf_cum_weights(len(user_ids), skew)
+    dictionary_weights = [zipf_cum_weights(len(ids), dictionary_skew)
+                          for ids in dictionary_ids]
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        owners = rng.choices(user_ids, cum_weights=user_weights, k=size)
+        types, currencies, mds, states = (
+            rng.choices(ids, cum_weights=weights, k=size)
+            for ids, weights in zip(dictionary_ids, dictionary_weights))
+        yield [{
+            'description': ' '.join(rng.sample(WORDS, 3)),
+            'type_id': types[index],
+            'currency_id': currencies[index],
+            'nominal_value': rng.choice(NOMINAL_VALUES),
+            'md_id': mds[index],
+            'state_id': states[index],
+            'year': str(rng.randint(1700, 2023)),
+            'serial_number': str(rng.randint(1, 10 ** 8)),
+            'user_id': owners[index],
+        } for index in range(size)]
+
+
+def drop_coin_indexes(connection):
+    """Индексы и триггеры счетчиков замедляют массовую вставку: они
+    удаляются до загрузки и создаются заново после нее"""
+    for index in models.Coins.__table__.indexes:
+        index.drop(connection, checkfirst=True)
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            'DROP INDEX IF EXISTS ix_coins_description_search'))
+        for name in models.STATS_TRIGGERS + models.VERSION_TRIGGERS:
+            connection.execute(text(
+                f'DROP TRIGGER IF EXISTS {name} '
+                f'ON "{models.Coins.__tablename__}"'))
+    elif connection.dialect.name == 'sqlite':
+        for name in models.STATS_TRIGGERS + models.VERSION_TRIGGERS:
+            connection.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+
+
+def create_coin_indexes(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SET LOCAL maintenance_work_mem = '512MB'"))
+        connection.execute(text("SET LOCAL work_mem = '256MB'"))
+    for index in models.Coins.__table__.indexes:
+        index.create(connection, checkfirst=True)
+    models.create_search_index(connection)
+    models.create_stats_triggers(connection)
+    models.create_version_triggers(connection)
+    # Пока триггеров не было, версии не менялись: ETag, выданные до
+    # загрузки, иначе остались бы действительными
+    connection.execute(text(models.COIN_VERSIONS_BUMP))
+
+
+async def can_skip_fk_checks(engine):
+    """session_replication_role может менять только суперпользователь"""
+    if engine.dialect.name != 'postgresql':
+        return False
+    async with engine.connect() as connection:
+        try:
+            await connection.execute(text(
+                'SET LOCAL session_replication_role = replica'))
+        except DBAPIError:
+            return False
+    return True
+
+
+async def generate(url, coins, users, dictionary_size=20, skew=1.0,
+                   dictionary_skew=0.0, seed=0, batch_size=10000,
+                   password='password', drop=False, skip_fk_checks=False):
+    """
+    Наполнение базы пользователями, справочниками и монетками.
+    skip_fk_checks - вставлять монетки без проверки внешних ключей
+    (PostgreSQL, только для суперпользователя; иначе обычная вставка)
+    """
+    engine = create_async_engine(url)
+    try:
+        async with engine.begin() as connection:
+            if drop:
+                await connection.run_sync(Base.metadata.drop_all)
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.run_sync(drop_coin_indexes)
+        try:
+            await load(engine, coins, users, dictionary_size, skew,
+                       dictionary_skew, seed, batch_size, password,
+                       skip_fk_checks and await can_skip_fk_checks(engine))
+        finally:
+            # Индексы и триггеры возвращаются и после ошибки загрузки
+            async with engine.begin() as connection:
+                await connection.run_sync(create_coin_indexes)
+    finally:
+        await engine.dispose()
+
+
+async def load(engine, coins, users, dictionary_size, skew, dictionary_skew,
+               seed, batch_size, password, skip_fk_checks):
+    async with AsyncSession(engine) as db:
+        for model in DICTIONARIES:
+            await db.execute(insert(model.__table__), [
+                {'name': f'{model.__tablename__} {index}'}
+                for index in range(dictionary_size)])
+        password_hash = pwd_context.hash(password)
+        for start in range(0, users, batch_size):
+            await db.execute(insert(models.User.__table__), [
+                {'username': f'user{index}', 'password': password_hash,
+                 'is_superuser': False}
+                for index in range(start, min(start + batch_size,
+                                              users))])
+        user_ids = (await db.execute(select(models.User.id).order_by(
+            models.User.id))).scalars().all()
+        dictionary_ids = [
+            (await db.execute(
+                select(model.id).order_by(model.id))).scalars().all()
+            for model in DICTIONARIES]
+        await db.commit()
+
+        batches = iter_coin_batches(coins, user_ids, dictionary_ids,
+                                    skew, dictionary_skew, seed,
+                                    batch_size)
+        # Следующая пачка готовится в потоке, пока база принимает текущую
+        batch = await asyncio.to_thread(next, batches, None)
+        while batch is not None:
+            next_batch = asyncio.create_task(
+                asyncio.to_thread(next, batches, None))
+            if skip_fk_checks:
+                # Ссылки берутся из уже вставленных строк, поэтому
+                # построчные проверки внешних ключей можно не делать
+                await db.execute(text(
+                    'SET LOCAL session_replication_role = replica'))
+            await insert_coins(db, batch)
+            await db.commit()
+            batch = await next_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--coins', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--dictionary-size', type=int, default=20)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of coins per user, 0 = uniform')
+    parser.add_argument('--dictionary-skew', type=float, default=0.0,
+                        help='Zipf exponent of coins per dictionary value')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--password', default='password',
+                        help='password of every generated user')
+    parser.add_argument('--database-url',
+                        default=SQLALCHEMY_ASYNC_DATABASE_URL)
+    parser.add_argument('--drop', action='store_true',
+                        help='drop existing tables first')
+    parser.add_argument('--skip-fk-checks', action='store_true',
+                        help='insert coins with session_replication_role = '
+                             'replica (PostgreSQL superuser only)')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    asyncio.run(generate(args.database_url, args.coins, args.users,
+                         args.dictionary_size, args.skew,
+                         args.dictionary_skew, args.seed, args.batch_size,
+                         args.password, args.drop, args.skip_fk_checks))
+    print(f'Generated {args.coins} coins in '
+          f'{time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
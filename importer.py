@@ -0,0 +1,156 @@
+import codecs
+import csv
+import json
+from collections import deque
+
+import asyncpg
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+COPY_COLUMNS = ('description', 'type_id', 'currency_id', 'nominal_value',
+                'md_id', 'state_id', 'year', 'serial_number', 'user_id')
+# Столько строк файла может занимать одна запись CSV с переводами строк
+# внутри кавычек
+MAX_RECORD_LINES = 100
+
+
+async def iter_lines(stream):
+    """Строки текста из потока байтов тела запроса"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    async for chunk in stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def quoted_after(line: str, quoted: bool) -> bool:
+    """
+    Остается ли открытым поле в кавычках после строки line. Кавычка
+    открывает поле только в его начале, как в csv.reader: кавычка внутри
+    значения без кавычек (5" coin) остается обычным символом
+    """
+    if '"' not in line:
+        return quoted
+    state = 'quoted' if quoted else 'start'
+    for char in line:
+        if state == 'quoted':
+            if char == '"':
+                state = 'closing'
+        elif state == 'closing' and char == '"':
+            # "" внутри кавычек - экранированная кавычка
+            state = 'quoted'
+        elif char == ',':
+            state = 'start'
+        elif state == 'start' and char == '"':
+            state = 'quoted'
+        else:
+            state = 'unquoted'
+    return state == 'quoted'
+
+
+async def iter_csv_lines(stream):
+    """
+    Физические строки, собранные в записи CSV: (строки, ошибка). Запись с
+    незакрытой кавычкой длиннее MAX_RECORD_LINES строк (или до конца
+    файла) отбрасывается одной ошибкой, и разбор продолжается со
+    следующей за ее началом строки
+    """
+    lines = iter_lines(stream)
+    pending = deque()
+    record = []
+    quoted = False
+    finished = False
+    while True:
+        if not pending and not finished:
+            line = await anext(lines, None)
+            if line is None:
+                finished = True
+            else:
+                pending.append(line)
+        if not pending:
+            if not record:
+                return
+            yield record[:1], 'Unterminated quoted field'
+            pending.extend(record[1:])
+            record, quoted = [], False
+            continue
+        line = pending.popleft()
+        record.append(line)
+        quoted = quoted_after(line, quoted)
+        if not quoted:
+            yield record, None
+            record = []
+        elif len(record) >= MAX_RECORD_LINES:
+            yield record[:1], 'Unterminated quoted field'
+            pending.extendleft(reversed(record[1:]))
+            record, quoted = [], False
+
+
+async def iter_csv_records(stream):
+    header = None
+    number = 0
+    async for lines, error in iter_csv_lines(stream):
+        if error is None and len(lines) == 1 and not lines[0].strip():
+            continue
+        values = None if error else next(csv.reader(['\n'.join(lines)]))
+        if header is None and values is not None:
+            header = values
+            continue
+        number += 1
+        if error:
+            yield number, None, error
+        elif len(values) != len(header):
+            yield number, None, f'Expected {len(header)} columns, ' \
+                                f'got {len(values)}'
+        else:
+            yield number, dict(zip(header, values)), None
+
+
+async def iter_ndjson_records(stream):
+    number = 0
+    async for line in iter_lines(stream):
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None, 'Invalid JSON'
+            continue
+        if not isinstance(record, dict):
+            yield number, None, 'Row must be a JSON object'
+        else:
+            yield number, record, None
+
+
+def iter_records(stream, format: str):
+    """Записи файла импорта: (номер строки, данные, ошибка разбора)"""
+    if format == 'csv':
+        return iter_csv_records(stream)
+    return iter_ndjson_records(stream)
+
+
+async def insert_coins(db: AsyncSession, rows):
+    """Вставка пачки монеток: COPY в PostgreSQL, executemany в остальных"""
+    if db.bind.dialect.name == 'postgresql':
+        connection = await db.connection()
+        raw_connection = await connection.get_raw_connection()
+        try:
+            await raw_connection.driver_connection.copy_records_to_table(
+                models.Coins.__tablename__, columns=COPY_COLUMNS,
+                records=[tuple(row[column] for column in COPY_COLUMNS)
+                         for row in rows])
+        except asyncpg.IntegrityConstraintViolationError as error:
+            # COPY выполняется в обход SQLAlchemy, ошибка приводится к
+            # тому же исключению, что и у executemany
+            raise IntegrityError('COPY', None, error) from error
+    else:
+        await db.execute(insert(models.Coins.__table__), rows)
@@ -1,12 +1,24 @@
+import time
+import warnings
+from contextlib import contextmanager
+
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, SAWarning
 
 from routers import dictionary, coin, user
 
+import metrics
 from config import settings
-from database import Base, engine
+from database import Base, create_database_if_missing, get_engine, \
+    get_async_engine
+from models import create_search_index, create_stats_triggers, \
+    create_version_triggers, make_username_unique
+from passwords import shutdown_executor
+from pool_stats import pool_stats
 
-Base.metadata.create_all(bind=engine)
 app = FastAPI()
 
 origins = [
@@ -25,7 +37,100 @@ app.include_router(dictionary.router, tags=['Dict'], prefix='/api/dictionary')
 app.include_router(coin.router, tags=['Coins'], prefix='/api/coins')
 app.include_router(user.router, tags=['User'], prefix='/api/user')
 
+if settings.METRICS_ENABLED:
+    metrics.install(app)
+
+
+# Номер advisory-блокировки PostgreSQL на время подготовки схемы
+SCHEMA_LOCK_ID = 20230117
+
+
+@contextmanager
+def schema_lock(engine):
+    """
+    Воркеры uvicorn готовят схему по очереди: одновременные CREATE TABLE и
+    CREATE TRIGGER из нескольких процессов падают на уникальных индексах
+    системного каталога
+    """
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    with engine.connect() as connection:
+        connection.execute(text('SELECT pg_advisory_lock(:id)'),
+                           {'id': SCHEMA_LOCK_ID})
+        try:
+            yield
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:id)'),
+                               {'id': SCHEMA_LOCK_ID})
+
+
+def prepare_database():
+    """Создание базы, таблиц, индексов и триггеров, которых еще нет"""
+    create_database_if_missing()
+    engine = get_engine()
+    with schema_lock(engine):
+        create_schema(engine)
+
+
+def create_schema(engine):
+    Base.metadata.create_all(bind=engine)
+    # create_all не добавляет индексы в уже существующие таблицы;
+    # индекс поиска по выражению SQLAlchemy прочитать не может
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Skipped unsupported reflection',
+                                SAWarning)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        with engine.begin() as connection:
+            make_username_unique(connection)
+    with engine.begin() as connection:
+        create_search_index(connection)
+        create_stats_triggers(connection)
+        create_version_triggers(connection)
+
+
+@app.on_event("startup")
+def init_database():
+    if not settings.DB_INIT_ON_STARTUP:
+        return
+    for attempt in range(1, settings.DB_INIT_ATTEMPTS + 1):
+        try:
+            prepare_database()
+            return
+        except OperationalError:
+            # База может быть еще недоступна при одновременном запуске
+            if attempt == settings.DB_INIT_ATTEMPTS:
+                raise
+            time.sleep(settings.DB_INIT_RETRY_DELAY * attempt)
+
+
+@app.on_event("startup")
+async def configure_threadpool():
+    # Потоков не больше, чем соединений в пуле: лишние запросы ждут
+    # свободный поток, а не соединение внутри уже занятого потока
+    to_thread.current_default_thread_limiter().total_tokens = (
+        settings.THREADPOOL_SIZE or
+        settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW)
+
+
+@app.on_event("shutdown")
+def stop_password_hashing():
+    shutdown_executor()
+
+
+@app.on_event("shutdown")
+async def close_database():
+    if get_async_engine.cache_info().currsize:
+        await get_async_engine().dispose()
+
 
 @app.get("/")
 def read_root():
     return {"Hello": "User"}
+
+
+@app.get("/health/db-pool")
+async def read_db_pool():
+    return pool_stats.snapshot(get_async_engine().sync_engine.pool)
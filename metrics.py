@@ -0,0 +1,193 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _format_labels(names, values, extra=''):
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values))
+    if extra:
+        labels = f'{labels},{extra}' if labels else extra
+    return '{' + labels + '}' if labels else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_format_labels(self.labels, labels)} {value}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, *labels, value: float):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            item[0][index] += 1
+        item[1] += value
+        item[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, labels, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            le = _format_labels(self.labels, labels, 'le="+Inf"')
+            yield f'{self.name}_bucket{le} {count}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} ' \
+                  f'{total}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} ' \
+                  f'{count}'
+
+
+REQUEST_LABELS = ('method', 'route')
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency',
+    REQUEST_LABELS)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'HTTP requests being processed',
+    REQUEST_LABELS)
+RESPONSES = Counter(
+    'http_responses_total', 'HTTP responses by status code',
+    REQUEST_LABELS + ('status',))
+SQL_STATEMENTS = Histogram(
+    'http_request_sql_statements', 'SQL statements per HTTP request',
+    REQUEST_LABELS, buckets=STATEMENT_BUCKETS)
+SQL_DURATION = Histogram(
+    'http_request_sql_duration_seconds', 'SQL time per HTTP request',
+    REQUEST_LABELS)
+
+METRICS = (REQUEST_LATENCY, REQUESTS_IN_FLIGHT, RESPONSES, SQL_STATEMENTS,
+           SQL_DURATION)
+
+
+class RequestSQL:
+    def __init__(self):
+        self.statements = 0
+        self.duration = 0.0
+
+
+request_sql: ContextVar[RequestSQL | None] = ContextVar('request_sql',
+                                                        default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if request_sql.get() is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    sql = request_sql.get()
+    if sql is not None and hasattr(context, 'metrics_started'):
+        sql.statements += 1
+        sql.duration += time.perf_counter() - context.metrics_started
+
+
+def route_template(router, scope):
+    """Шаблон пути маршрута вместо фактического пути запроса"""
+    partial = None
+    for route in router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or 'unmatched'
+
+
+class MetricsMiddleware:
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        labels = (scope['method'], route_template(self.router, scope))
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        sql = RequestSQL()
+        token = request_sql.set(sql)
+        REQUESTS_IN_FLIGHT.inc(*labels)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_LATENCY.observe(*labels,
+                                    value=time.perf_counter() - started)
+            REQUESTS_IN_FLIGHT.dec(*labels)
+            RESPONSES.inc(*labels, status_code)
+            SQL_STATEMENTS.observe(*labels, value=sql.statements)
+            SQL_DURATION.observe(*labels, value=sql.duration)
+            request_sql.reset(token)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def install(app):
+    """Подключение сбора метрик и эндпоинта /metrics к приложению"""
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.add_middleware(MetricsMiddleware, router=app.router)
+
+    @app.get('/metrics', include_in_schema=False)
+    async def read_metrics():
+        return PlainTextResponse(
+            render(), media_type='text/plain; version=0.0.4')
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, Float, \
+    Index, and_, case, cast, event, func, inspect, literal_column, select, \
+    text
+from sqlalchemy.orm import relationship, joinedload
 from database import Base
 
 
@@ -10,24 +12,32 @@ class Coins(Base):
     id = Column(Integer, primary_key=True, index=True, nullable=False)
     description = Column(String, nullable=True)
     type_id = Column(Integer, ForeignKey('type.id', ondelete='SET NULL'),
-                     nullable=True)
+                     nullable=True, index=True)
     type = relationship("Type")
     currency_id = Column(Integer,
                          ForeignKey("currency.id", ondelete='SET NULL'),
-                         nullable=True)
+                         nullable=True, index=True)
     currency = relationship("Currency")
     nominal_value = Column(String, nullable=True)
     md_id = Column(Integer, ForeignKey("md.id", ondelete='SET NULL'),
-                   nullable=True)
+                   nullable=True, index=True)
     md = relationship("Md")
     state_id = Column(Integer, ForeignKey("state.id", ondelete='SET NULL'),
-                      nullable=True)
+                      nullable=True, index=True)
     state = relationship("State")
     year = Column(String, nullable=True)
     serial_number = Column(String, nullable=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete='CASCADE'))
     user = relationship("User")
 
+    # Список монеток пользователя с постраничной выдачей по id;
+    # покрывает и отдельный поиск по user_id
+    __table_args__ = (
+        Index('ix_coins_user_id_id', 'user_id', 'id'),
+        Index('ix_coins_serial_number', 'serial_number',
+              postgresql_ops={'serial_number': 'text_pattern_ops'}),
+    )
+
 
 class Type(Base):
     """Тип"""
@@ -57,10 +67,476 @@ class State(Base):
     name = Column(String)
 
 
+class CoinStats(Base):
+    """Число монеток пользователя по типу, валюте, государству и году"""
+    __tablename__ = "coin_stats"
+    user_id = Column(Integer, ForeignKey("user.id", ondelete='CASCADE'),
+                     primary_key=True)
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class CoinStatsTotal(Base):
+    """
+    Те же счетчики по всем пользователям, разбитые на слоты по id
+    владельца: статистика суперпользователя не суммирует строки каждого
+    пользователя, а изменения разных пользователей реже ждут друг друга
+    """
+    __tablename__ = "coin_stats_total"
+    slot = Column(Integer, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class CollectionVersion(Base):
+    """
+    Версия коллекции для ETag: монетки пользователя (part - id владельца),
+    все монетки (part - слот по id владельца) и справочники (part = 0)
+    """
+    __tablename__ = "collection_versions"
+    collection = Column(String, primary_key=True)
+    part = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class User(Base):
     """Пользователи"""
     __tablename__ = "user"
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, index=True)
+    username = Column(String, index=True, unique=True)
     password = Column(String)
     is_superuser = Column(Boolean(), default=False)
+
+
+def make_username_unique(connection):
+    """
+    В базах, созданных до уникальности имен, ix_user_username остался
+    обычным индексом: create_all и index.create(checkfirst) находят его по
+    имени и не пересоздают. Такой индекс заменяется уникальным
+    """
+    index = next(index for index in User.__table__.indexes
+                 if index.name == 'ix_user_username')
+    existing = {item['name']: item for item
+                in inspect(connection).get_indexes(User.__tablename__)}
+    if existing.get(index.name, {'unique': True})['unique']:
+        return
+    duplicates = connection.execute(
+        select(User.username).group_by(User.username).having(
+            func.count() > 1)).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            f'Usernames must be unique before ix_user_username can be '
+            f'rebuilt, duplicated: {", ".join(duplicates[:10])}')
+    index.drop(connection)
+    index.create(connection)
+
+
+class RevokedToken(Base):
+    """
+    Отозванные токены: один токен по jti или, если jti пуст, все токены
+    пользователя, выданные до revoked_at. Время - unix time, как в JWT
+    """
+    __tablename__ = "revoked_tokens"
+    id = Column(Integer, primary_key=True)
+    jti = Column(String, nullable=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete='CASCADE'),
+                     nullable=False)
+    revoked_at = Column(Float, nullable=False, index=True)
+    # После этого момента отозванные токены истекли сами
+    expires_at = Column(Float, nullable=False, index=True)
+
+
+# Справочники и владелец подгружаются одним запросом вместе с монеткой
+COIN_LOAD_OPTIONS = (
+    joinedload(Coins.type),
+    joinedload(Coins.currency),
+    joinedload(Coins.md),
+    joinedload(Coins.state),
+    joinedload(Coins.user),
+)
+
+
+# Полнотекстовый поиск по описанию монетки: GIN-индекс по tsvector в
+# PostgreSQL и внешняя таблица FTS5 в SQLite
+SEARCH_CONFIG = 'russian'
+
+coins_search_vector = func.to_tsvector(
+    literal_column(f"'{SEARCH_CONFIG}'::regconfig"),
+    func.coalesce(Coins.description, literal_column("''")))
+
+POSTGRESQL_SEARCH_DDL = (
+    f"CREATE INDEX IF NOT EXISTS ix_coins_description_search "
+    f"ON \"{Coins.__tablename__}\" USING gin "
+    f"(to_tsvector('{SEARCH_CONFIG}'::regconfig, "
+    f"coalesce(description, '')))",
+)
+
+SQLITE_SEARCH_DDL = (
+    f"CREATE VIRTUAL TABLE coins_search USING fts5(description, "
+    f"content='{Coins.__tablename__}', content_rowid='id')",
+    f"CREATE TRIGGER coins_search_insert AFTER INSERT "
+    f"ON \"{Coins.__tablename__}\" BEGIN "
+    f"INSERT INTO coins_search(rowid, description) "
+    f"VALUES (new.id, new.description); END",
+    f"CREATE TRIGGER coins_search_delete AFTER DELETE "
+    f"ON \"{Coins.__tablename__}\" BEGIN "
+    f"INSERT INTO coins_search(coins_search, rowid, description) "
+    f"VALUES ('delete', old.id, old.description); END",
+    f"CREATE TRIGGER coins_search_update AFTER UPDATE "
+    f"ON \"{Coins.__tablename__}\" BEGIN "
+    f"INSERT INTO coins_search(coins_search, rowid, description) "
+    f"VALUES ('delete', old.id, old.description); "
+    f"INSERT INTO coins_search(rowid, description) "
+    f"VALUES (new.id, new.description); END",
+    "INSERT INTO coins_search(coins_search) VALUES ('rebuild')",
+)
+
+
+def create_search_index(connection):
+    """Создание индекса полнотекстового поиска, если его еще нет"""
+    if connection.dialect.name == 'postgresql':
+        statements = POSTGRESQL_SEARCH_DDL
+    elif connection.dialect.name == 'sqlite':
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'coins_search'"))
+        statements = () if exists.first() else SQLITE_SEARCH_DDL
+    else:
+        statements = ()
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+@event.listens_for(Coins.__table__, 'after_create')
+def _create_search_index(target, connection, **kw):
+    create_search_index(connection)
+
+
+@event.listens_for(Coins.__table__, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS coins_search'))
+
+
+def coins_search_clause(dialect_name: str, search: str):
+    """Условие отбора монеток по словам из описания"""
+    if dialect_name == 'sqlite':
+        words = ' '.join('"{}"*'.format(word.replace('"', '""'))
+                         for word in search.split())
+        return Coins.id.in_(
+            select(literal_column('rowid')).select_from(
+                text('coins_search')).where(
+                literal_column('coins_search').op('MATCH')(words)))
+    return coins_search_vector.op('@@')(
+        func.plainto_tsquery(
+            literal_column(f"'{SEARCH_CONFIG}'::regconfig"), search))
+
+
+def coins_year_number(dialect_name: str):
+    """
+    Год монетки числом для сравнения диапазоном; год хранится строкой, и
+    для записанного не числом (или слишком длинного) выражение дает NULL
+    """
+    year = Coins.year
+    if dialect_name == 'postgresql':
+        is_number = year.op('~')('^[0-9]{1,9}$')
+    else:
+        is_number = and_(year != '', func.length(year) <= 9,
+                         year.op('NOT GLOB')('*[^0-9]*'))
+    return case((is_number, cast(year, Integer)))
+
+
+# Счетчики coin_stats ведутся триггерами на таблице монеток, поэтому
+# обновляются в той же транзакции при любом изменении, в том числе при
+# COPY и при обнулении ссылок после удаления записи справочника
+STATS_DIMENSIONS = {
+    'type': 'type_id',
+    'currency': 'currency_id',
+    'state': 'state_id',
+    'year': 'year',
+}
+
+
+STATS_SLOTS = 16
+STATS_TRIGGERS = ('coin_stats_insert', 'coin_stats_update',
+                  'coin_stats_delete')
+
+
+def _stats_keys(row: str):
+    return ' OR '.join(
+        f"(dimension = '{dimension}' "
+        f"AND value = coalesce(CAST({row}.{column} AS TEXT), ''))"
+        for dimension, column in STATS_DIMENSIONS.items())
+
+
+def _stats_row_increment(row: str, table: str, key: str, part: str):
+    values = ', '.join(
+        f"({part}, '{dimension}', "
+        f"coalesce(CAST({row}.{column} AS TEXT), ''), 1)"
+        for dimension, column in STATS_DIMENSIONS.items())
+    return (f"INSERT INTO {table} ({key}, dimension, value, count) "
+            f"SELECT * FROM (VALUES {values}) AS coin "
+            f"WHERE {row}.user_id IS NOT NULL "
+            f"ON CONFLICT ({key}, dimension, value) "
+            f"DO UPDATE SET count = {table}.count + 1")
+
+
+def _stats_row_decrement(row: str, table: str, key: str, part: str):
+    where = f"{key} = {part} AND ({_stats_keys(row)})"
+    return (f"UPDATE {table} SET count = count - 1 WHERE {where}; "
+            f"DELETE FROM {table} WHERE count = 0 AND {where}")
+
+
+def _stats_row(change, row: str):
+    """Изменение счетчиков пользователя и слота одной строкой монетки"""
+    slot = f'{row}.user_id % {STATS_SLOTS}'
+    return (f"{change(row, 'coin_stats', 'user_id', f'{row}.user_id')}; "
+            f"{change(row, 'coin_stats_total', 'slot', slot)}")
+
+
+def _stats_changes(table: str, diff: int):
+    """Строки изменений счетчиков от всех монеток таблицы переходов"""
+    values = ', '.join(
+        f"('{dimension}', coalesce(CAST(coin.{column} AS TEXT), ''))"
+        for dimension, column in STATS_DIMENSIONS.items())
+    return (f"SELECT coin.user_id, coin.user_id % {STATS_SLOTS} AS slot, "
+            f"stat.dimension, stat.value, {diff} AS diff FROM {table} AS coin "
+            f"CROSS JOIN LATERAL (VALUES {values}) "
+            f"AS stat (dimension, value) WHERE coin.user_id IS NOT NULL")
+
+
+def _stats_apply(changes: str, table: str, key: str):
+    """Одно агрегированное изменение счетчиков на весь оператор; строки
+    обновляются в порядке ключа, чтобы параллельные записи не
+    взаимоблокировались"""
+    return (f"INSERT INTO {table} ({key}, dimension, value, count) "
+            f"SELECT {key}, dimension, value, sum(diff) "
+            f"FROM ({changes}) AS changes "
+            f"GROUP BY {key}, dimension, value HAVING sum(diff) <> 0 "
+            f"ORDER BY {key}, dimension, value "
+            f"ON CONFLICT ({key}, dimension, value) "
+            f"DO UPDATE SET count = {table}.count + EXCLUDED.count")
+
+
+def _stats_prune(changes: str, table: str, key: str):
+    return (f"DELETE FROM {table} WHERE count = 0 "
+            f"AND ({key}, dimension, value) IN "
+            f"(SELECT {key}, dimension, value FROM ({changes}) AS changes)")
+
+
+def _stats_statement(changes: str, removed: bool):
+    statements = [_stats_apply(changes, 'coin_stats', 'user_id'),
+                  _stats_apply(changes, 'coin_stats_total', 'slot')]
+    if removed:
+        old = _stats_changes('old_coins', -1)
+        statements += [_stats_prune(old, 'coin_stats', 'user_id'),
+                       _stats_prune(old, 'coin_stats_total', 'slot')]
+    return '; '.join(statements)
+
+
+STATS_COLUMNS = ', '.join(['user_id', *STATS_DIMENSIONS.values()])
+
+STATS_BACKFILL = (
+    "DELETE FROM coin_stats",
+    "DELETE FROM coin_stats_total",
+    "INSERT INTO coin_stats (user_id, dimension, value, count) " +
+    " UNION ALL ".join(
+        f"SELECT user_id, '{dimension}', "
+        f"coalesce(CAST({column} AS TEXT), ''), count(*) "
+        f"FROM \"{Coins.__tablename__}\" WHERE user_id IS NOT NULL "
+        f"GROUP BY user_id, {column}"
+        for dimension, column in STATS_DIMENSIONS.items()),
+    f"INSERT INTO coin_stats_total (slot, dimension, value, count) "
+    f"SELECT user_id % {STATS_SLOTS}, dimension, value, sum(count) "
+    f"FROM coin_stats GROUP BY user_id % {STATS_SLOTS}, dimension, value",
+)
+
+# Триггеры уровня оператора: массовая вставка (в том числе COPY) меняет
+# каждую строку счетчика один раз, а не на каждую монетку. Таблицы
+# переходов допускаются только у триггеров на одно событие
+_STATS_UPDATE_CHANGES = (_stats_changes('old_coins', -1) + ' UNION ALL '
+                         + _stats_changes('new_coins', 1))
+
+POSTGRESQL_STATS_DDL = (
+    f"DROP TRIGGER IF EXISTS coin_stats_refresh "
+    f"ON \"{Coins.__tablename__}\"",
+    f"CREATE OR REPLACE FUNCTION coin_stats_refresh() RETURNS trigger AS $$ "
+    f"BEGIN "
+    f"IF TG_OP = 'INSERT' THEN "
+    f"{_stats_statement(_stats_changes('new_coins', 1), False)}; "
+    f"ELSIF TG_OP = 'DELETE' THEN "
+    f"{_stats_statement(_stats_changes('old_coins', -1), True)}; "
+    f"ELSE {_stats_statement(_STATS_UPDATE_CHANGES, True)}; "
+    f"END IF; "
+    f"RETURN NULL; "
+    f"END $$ LANGUAGE plpgsql",
+    f"CREATE OR REPLACE TRIGGER coin_stats_insert "
+    f"AFTER INSERT ON \"{Coins.__tablename__}\" "
+    f"REFERENCING NEW TABLE AS new_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_stats_refresh()",
+    f"CREATE OR REPLACE TRIGGER coin_stats_update "
+    f"AFTER UPDATE ON \"{Coins.__tablename__}\" "
+    f"REFERENCING OLD TABLE AS old_coins NEW TABLE AS new_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_stats_refresh()",
+    f"CREATE OR REPLACE TRIGGER coin_stats_delete "
+    f"AFTER DELETE ON \"{Coins.__tablename__}\" "
+    f"REFERENCING OLD TABLE AS old_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_stats_refresh()",
+)
+
+# В SQLite нет триггеров уровня оператора, но нет и проблемы с
+# накоплением версий строк: счетчики меняются построчно
+SQLITE_STATS_DDL = (
+    *(f"DROP TRIGGER IF EXISTS {name}" for name in STATS_TRIGGERS),
+    f"CREATE TRIGGER coin_stats_insert AFTER INSERT "
+    f"ON \"{Coins.__tablename__}\" "
+    f"BEGIN {_stats_row(_stats_row_increment, 'new')}; END",
+    f"CREATE TRIGGER coin_stats_delete AFTER DELETE "
+    f"ON \"{Coins.__tablename__}\" "
+    f"BEGIN {_stats_row(_stats_row_decrement, 'old')}; END",
+    f"CREATE TRIGGER coin_stats_update AFTER UPDATE OF {STATS_COLUMNS} "
+    f"ON \"{Coins.__tablename__}\" "
+    f"BEGIN {_stats_row(_stats_row_decrement, 'old')}; "
+    f"{_stats_row(_stats_row_increment, 'new')}; END",
+)
+
+
+def create_stats_triggers(connection):
+    """Заполнение счетчиков и создание поддерживающих их триггеров"""
+    if connection.dialect.name == 'postgresql':
+        exists = connection.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'coin_stats_insert' "
+            "AND tgrelid = to_regclass(:table)"),
+            {'table': f'"{Coins.__tablename__}"'})
+        statements = POSTGRESQL_STATS_DDL
+    elif connection.dialect.name == 'sqlite':
+        # Триггеры без счетчиков по слотам пересоздаются
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'coin_stats_insert' "
+            "AND sql LIKE '%coin_stats_total%'"))
+        statements = SQLITE_STATS_DDL
+    else:
+        return
+    if exists.first():
+        return
+    for statement in STATS_BACKFILL + statements:
+        connection.execute(text(statement))
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_stats_triggers(target, connection, **kw):
+    create_stats_triggers(connection)
+
+
+# Версии коллекций тоже ведутся триггерами. Версия всех монеток разбита
+# на слоты, чтобы изменения монеток разных пользователей не ждали
+# блокировки одной строки
+VERSION_SLOTS = 16
+DICTIONARY_TABLES = ('type', 'currency', 'md', 'state')
+
+
+def _version_bump(values: str):
+    return (f"INSERT INTO collection_versions (collection, part, version) "
+            f"SELECT * FROM (VALUES {values}) AS changed WHERE true "
+            f"ON CONFLICT (collection, part) "
+            f"DO UPDATE SET version = collection_versions.version + 1")
+
+
+def _coin_version_bump(row: str):
+    return _version_bump(
+        f"('coins', coalesce({row}.user_id, 0), 1), "
+        f"('coins_all', coalesce({row}.user_id, 0) % {VERSION_SLOTS}, 1)")
+
+
+def _coin_versions_bump(*tables: str):
+    """Одно изменение версий на оператор: по разу на владельца и слот"""
+    owners = ' UNION '.join(f"SELECT DISTINCT coalesce(user_id, 0) "
+                            f"AS user_id FROM {table}" for table in tables)
+    return (f"WITH owners AS ({owners}) "
+            f"INSERT INTO collection_versions (collection, part, version) "
+            f"SELECT 'coins', user_id, 1 FROM owners UNION "
+            f"SELECT 'coins_all', user_id % {VERSION_SLOTS}, 1 FROM owners "
+            f"ORDER BY 1, 2 "
+            f"ON CONFLICT (collection, part) "
+            f"DO UPDATE SET version = collection_versions.version + 1")
+
+
+# Новые версии всех владельцев монеток и их слотов, например после
+# загрузки со снятыми триггерами
+COIN_VERSIONS_BUMP = _coin_versions_bump(f'"{Coins.__tablename__}"')
+
+
+def _dictionary_version(table: str):
+    return f"('{table}', 0, 1)"
+
+
+VERSION_TRIGGERS = ('coin_versions_insert', 'coin_versions_update',
+                    'coin_versions_delete')
+
+POSTGRESQL_VERSIONS_DDL = (
+    f"DROP TRIGGER IF EXISTS coin_versions_bump "
+    f"ON \"{Coins.__tablename__}\"",
+    f"CREATE OR REPLACE FUNCTION coin_versions_bump() RETURNS trigger AS $$ "
+    f"BEGIN "
+    f"IF TG_OP = 'INSERT' THEN {_coin_versions_bump('new_coins')}; "
+    f"ELSIF TG_OP = 'DELETE' THEN {_coin_versions_bump('old_coins')}; "
+    f"ELSE {_coin_versions_bump('old_coins', 'new_coins')}; "
+    f"END IF; "
+    f"RETURN NULL; "
+    f"END $$ LANGUAGE plpgsql",
+    f"CREATE OR REPLACE TRIGGER coin_versions_insert "
+    f"AFTER INSERT ON \"{Coins.__tablename__}\" "
+    f"REFERENCING NEW TABLE AS new_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_versions_bump()",
+    f"CREATE OR REPLACE TRIGGER coin_versions_update "
+    f"AFTER UPDATE ON \"{Coins.__tablename__}\" "
+    f"REFERENCING OLD TABLE AS old_coins NEW TABLE AS new_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_versions_bump()",
+    f"CREATE OR REPLACE TRIGGER coin_versions_delete "
+    f"AFTER DELETE ON \"{Coins.__tablename__}\" "
+    f"REFERENCING OLD TABLE AS old_coins "
+    f"FOR EACH STATEMENT EXECUTE FUNCTION coin_versions_bump()",
+    f"CREATE OR REPLACE FUNCTION dictionary_versions_bump() "
+    f"RETURNS trigger AS $$ "
+    f"BEGIN "
+    f"{_version_bump('(CAST(TG_TABLE_NAME AS TEXT), 0, 1)')}; "
+    f"RETURN NULL; "
+    f"END $$ LANGUAGE plpgsql",
+    *(f"CREATE OR REPLACE TRIGGER {table}_versions_bump "
+      f"AFTER INSERT OR UPDATE OR DELETE ON \"{table}\" "
+      f"FOR EACH STATEMENT EXECUTE FUNCTION dictionary_versions_bump()"
+      for table in DICTIONARY_TABLES),
+)
+
+SQLITE_VERSIONS_DDL = (
+    f"CREATE TRIGGER IF NOT EXISTS coin_versions_insert AFTER INSERT "
+    f"ON \"{Coins.__tablename__}\" BEGIN {_coin_version_bump('new')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS coin_versions_delete AFTER DELETE "
+    f"ON \"{Coins.__tablename__}\" BEGIN {_coin_version_bump('old')}; END",
+    f"CREATE TRIGGER IF NOT EXISTS coin_versions_update AFTER UPDATE "
+    f"ON \"{Coins.__tablename__}\" BEGIN {_coin_version_bump('old')}; "
+    f"{_coin_version_bump('new')}; END",
+    *(f"CREATE TRIGGER IF NOT EXISTS {table}_versions_{operation.lower()} "
+      f"AFTER {operation} ON \"{table}\" "
+      f"BEGIN {_version_bump(_dictionary_version(table))}; END"
+      for table in DICTIONARY_TABLES
+      for operation in ('INSERT', 'UPDATE', 'DELETE')),
+)
+
+
+def create_version_triggers(connection):
+    """Создание триггеров версий коллекций, если их еще нет"""
+    if connection.dialect.name == 'postgresql':
+        statements = POSTGRESQL_VERSIONS_DDL
+    elif connection.dialect.name == 'sqlite':
+        statements = SQLITE_VERSIONS_DDL
+    else:
+        statements = ()
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_version_triggers(target, connection, **kw):
+    create_version_triggers(connection)
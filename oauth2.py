@@ -1,12 +1,20 @@
 import base64
-from typing import List
+import hashlib
+import time
+from typing import List, NamedTuple
+import orjson
 from fastapi import Depends, HTTPException, status
-from fastapi_jwt_auth import AuthJWT
+from fastapi_jwt_auth import AuthJWT as BaseAuthJWT
 from pydantic import BaseModel
 
 import models
+from cache import Codec, TTLCache, create_cache
 from database import get_db
-from sqlalchemy.orm import Session
+from revocation import denylist
+from sqlalchemy import event, select
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.util import await_only
+from sqlalchemy.ext.asyncio import AsyncSession
 from config import settings
 
 
@@ -17,17 +25,96 @@ class Settings(BaseModel):
     authjwt_access_cookie_key: str = 'access_token'
     authjwt_refresh_cookie_key: str = 'refresh_token'
     authjwt_cookie_csrf_protect: bool = False
+    authjwt_denylist_enabled: bool = True
+    authjwt_denylist_token_checks: set = {'access', 'refresh'}
     authjwt_public_key: str = base64.b64decode(
         settings.JWT_PUBLIC_KEY).decode('utf-8')
     authjwt_private_key: str = base64.b64decode(
         settings.JWT_PRIVATE_KEY).decode('utf-8')
 
 
+class ClaimsCache:
+    """
+    Проверенные claims по хэшу токена: повторная проверка подписи RS256
+    того же токена пропускается. Запись не переживает exp токена, а при
+    смене ключа кэш сбрасывается
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize, ttl)
+        self.public_key = None
+
+    @staticmethod
+    def _key(token: str, issuer):
+        return hashlib.blake2b(token.encode(), digest_size=16).digest(), issuer
+
+    def get(self, token: str, issuer, public_key):
+        if public_key != self.public_key:
+            self.cache.clear()
+            self.public_key = public_key
+            return None
+        claims = self.cache.get(self._key(token, issuer))
+        if claims is None or claims.get('exp', 0) <= time.time():
+            return None
+        return dict(claims)
+
+    def set(self, token: str, issuer, public_key, claims):
+        if public_key == self.public_key and 'exp' in claims:
+            self.cache.set(self._key(token, issuer), dict(claims))
+
+
+claims_cache = ClaimsCache(settings.JWT_CLAIMS_CACHE_SIZE,
+                           settings.JWT_CLAIMS_CACHE_TTL)
+
+
+class AuthJWT(BaseAuthJWT):
+    """AuthJWT с кэшем проверенных токенов"""
+
+    def _verified_token(self, encoded_token, issuer=None):
+        claims = claims_cache.get(encoded_token, issuer, self._public_key)
+        if claims is None:
+            claims = super()._verified_token(encoded_token, issuer)
+            claims_cache.set(encoded_token, issuer, self._public_key, claims)
+        return claims
+
+
 @AuthJWT.load_config
 def get_config():
     return Settings()
 
 
+@AuthJWT.token_in_denylist_loader
+def is_token_revoked(decrypted_token):
+    return denylist.is_revoked(decrypted_token)
+
+
+class Principal(NamedTuple):
+    """Аутентифицированный пользователь"""
+    id: int
+    is_superuser: bool
+
+
+PRINCIPAL_CODEC = Codec(lambda principal: orjson.dumps(tuple(principal)),
+                        lambda data: Principal(*orjson.loads(data)))
+
+principal_cache = create_cache('principal', settings.PRINCIPAL_CACHE_SIZE,
+                               settings.PRINCIPAL_CACHE_TTL, PRINCIPAL_CODEC)
+
+
+@event.listens_for(models.User, 'after_insert')
+@event.listens_for(models.User, 'after_update')
+@event.listens_for(models.User, 'after_delete')
+def invalidate_principal(mapper, connection, target):
+    # flush асинхронной сессии идет внутри greenlet, в котором можно
+    # дождаться удаления из кэша
+    deleting = principal_cache.delete(target.id)
+    try:
+        await_only(deleting)
+    except MissingGreenlet:
+        # Синхронная сессия вне приложения, например при наполнении базы
+        deleting.close()
+
+
 class NotVerified(Exception):
     pass
 
@@ -36,15 +123,26 @@ class UserNotFound(Exception):
     pass
 
 
-def require_user(db: Session = Depends(get_db),
-                 Authorize: AuthJWT = Depends()):
+async def require_user(db: AsyncSession = Depends(get_db),
+                       Authorize: AuthJWT = Depends()):
+    await denylist.sync(db)
     try:
         Authorize.jwt_required()
-        user_id = Authorize.get_jwt_subject()
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        user_id = int(Authorize.get_jwt_subject())
+        principal = await principal_cache.get(user_id)
+        if principal is None:
+            # Строка пользователя заблокирована на чтение до конца запроса:
+            # изменение пользователя дождется записи в кэш и сбросит ее,
+            # а не окажется перезаписано прочитанными до него данными
+            result = await db.execute(
+                select(models.User.id, models.User.is_superuser).where(
+                    models.User.id == user_id).with_for_update(read=True))
+            user = result.first()
 
-        if not user:
-            raise UserNotFound('User does not exist')
+            if not user:
+                raise UserNotFound('User does not exist')
+            principal = Principal(user.id, bool(user.is_superuser))
+            await principal_cache.set(user_id, principal)
 
     except Exception as e:
         error = e.__class__.__name__
@@ -60,4 +158,4 @@ def require_user(db: Session = Depends(get_db),
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Token is invalid or has expired')
-    return user_id
+    return principal
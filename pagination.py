@@ -0,0 +1,23 @@
+import base64
+import binascii
+
+from fastapi import HTTPException, status
+
+
+def encode_cursor(last_id: int) -> str:
+    """Непрозрачный курсор на запись, следующую за last_id"""
+    raw = f'id:{last_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """Разбор курсора, полученного от клиента"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        prefix, value = base64.urlsafe_b64decode(padded).decode().split(':')
+        if prefix != 'id':
+            raise ValueError(cursor)
+        return int(value)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Invalid cursor')
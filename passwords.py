@@ -0,0 +1,66 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from config import settings
+
+# Хэши с другим числом раундов считаются устаревшими и пересчитываются
+# при следующем успешном входе
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=settings.BCRYPT_ROUNDS)
+
+_executor = None
+_pending = 0
+
+
+def _hash(password: str):
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def get_executor():
+    """Пул процессов для bcrypt, создается при первом обращении"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= settings.PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many authentication requests',
+                            headers={'Retry-After': '1'})
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str):
+    return await _run(_hash, password)
+
+
+async def verify_password(password: str, hashed_password: str):
+    """Проверка пароля, возвращает (верен ли пароль, новый хэш или None)"""
+    return await _run(_verify_and_update, password, hashed_password)
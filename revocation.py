@@ -0,0 +1,114 @@
+import time
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from config import settings
+
+# Запас на транзакции, закоммиченные позже соседних, и расхождение часов
+SYNC_OVERLAP = 60
+# Время выдачи токена с долями секунды: iat в целых секундах не отличает
+# токен повторного входа от отозванного в ту же секунду
+ISSUED_AT_CLAIM = 'issued_at'
+
+
+def issued_claims():
+    """Дополнительные claims нового access или refresh токена"""
+    return {ISSUED_AT_CLAIM: time.time()}
+
+
+class Denylist:
+    """
+    Копия отозванных токенов в памяти процесса: проверка токена - два
+    поиска в словарях. Записи из базы подгружаются не чаще раза в
+    sync_interval секунд и удаляются, когда отозванные токены истекают
+    """
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self.clear()
+
+    def clear(self, loaded: bool = False):
+        """loaded - база заведомо не содержит отзывов, читать ее не нужно"""
+        self.tokens = {}  # jti -> exp
+        self.users = {}  # id пользователя -> (revoked_at, expires_at)
+        self.synced_at = time.time() if loaded else None
+        self.next_sync = (time.monotonic() + self.sync_interval
+                          if loaded else 0)
+
+    def add(self, jti, user_id, revoked_at, expires_at):
+        if jti is not None:
+            self.tokens[jti] = expires_at
+            return
+        current = self.users.get(user_id)
+        if current is None or current[0] < revoked_at:
+            self.users[user_id] = revoked_at, expires_at
+
+    def is_revoked(self, claims) -> bool:
+        if claims.get('jti') in self.tokens:
+            return True
+        revoked = self.users.get(int(claims['sub']))
+        if revoked is None:
+            return False
+        # У токенов, выданных без issued_at, остается iat: выданный в ту же
+        # секунду, что и отзыв, тоже считается отозванным
+        issued_at = claims.get(ISSUED_AT_CLAIM, claims.get('iat', 0))
+        return issued_at <= revoked[0]
+
+    def prune(self, now: float):
+        self.tokens = {jti: expires_at
+                       for jti, expires_at in self.tokens.items()
+                       if expires_at > now}
+        self.users = {user_id: revoked for user_id, revoked
+                      in self.users.items() if revoked[1] > now}
+
+    async def sync(self, db: AsyncSession):
+        """Подгрузка отзывов, сделанных другими процессами"""
+        if time.monotonic() < self.next_sync:
+            return
+        self.next_sync = time.monotonic() + self.sync_interval
+        now = time.time()
+        revoked = models.RevokedToken
+        query = select(revoked.jti, revoked.user_id, revoked.revoked_at,
+                       revoked.expires_at).where(revoked.expires_at > now)
+        if self.synced_at is not None:
+            query = query.where(
+                revoked.revoked_at >= self.synced_at - SYNC_OVERLAP)
+        for row in await db.execute(query):
+            self.add(*row)
+        self.synced_at = now
+        self.prune(now)
+
+
+denylist = Denylist(settings.TOKEN_DENYLIST_SYNC_INTERVAL)
+
+
+async def _revoke(db: AsyncSession, rows):
+    now = time.time()
+    rows = [dict(row, revoked_at=now) for row in rows]
+    # Истекшие отзывы больше ничего не запрещают
+    await db.execute(delete(models.RevokedToken).where(
+        models.RevokedToken.expires_at <= now))
+    await db.execute(insert(models.RevokedToken), rows)
+    await db.commit()
+    for row in rows:
+        denylist.add(row['jti'], row['user_id'], row['revoked_at'],
+                     row['expires_at'])
+
+
+async def revoke_tokens(db: AsyncSession, claims_list):
+    """Отзыв конкретных токенов по их claims"""
+    rows = [{'jti': claims['jti'], 'user_id': int(claims['sub']),
+             'expires_at': claims['exp']}
+            for claims in claims_list if 'jti' in claims]
+    if rows:
+        await _revoke(db, rows)
+
+
+async def revoke_user_tokens(db: AsyncSession, user_id: int):
+    """Отзыв всех выданных до этого момента токенов пользователя"""
+    lifetime = max(settings.ACCESS_TOKEN_EXPIRES_IN,
+                   settings.REFRESH_TOKEN_EXPIRES_IN) * 60
+    await _revoke(db, [{'jti': None, 'user_id': user_id,
+                        'expires_at': time.time() + lifetime}])
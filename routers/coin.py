@@ -1,75 +1,577 @@
+import csv
+import io
+import json
+from typing import List, NamedTuple
+
+from sqlalchemy import select, insert, update, delete, bindparam, func, \
+    literal_column, union_all
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, status, APIRouter, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from fastapi import Depends, HTTPException, status, APIRouter, Response, \
+    Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
 
 import schemas
 import models
+from cache import BYTES_CODEC, create_cache
+from config import settings
 from database import get_db
-from oauth2 import require_user
+from etags import coins_versions, is_not_modified, make_etag, not_modified
+from importer import iter_records, insert_coins
+from oauth2 import require_user, Principal
+from pagination import encode_cursor, decode_cursor
+from serializers import RowSerializer
 
 router = APIRouter()
 
+# Список монеток собирается из строк запроса в обход проверки схемой
+coin_serializer = RowSerializer(schemas.CoinResponse, models.Coins)
+# Готовые ответы списка по ETag: ETag меняется с любой записью в видимых
+# монетках, поэтому сбрасывать кэш не нужно
+coins_cache = create_cache('coins', settings.COINS_CACHE_SIZE,
+                           settings.COINS_CACHE_TTL, BYTES_CODEC,
+                           settings.COINS_CACHE_MAX_BYTES)
+
+# Плоское представление монетки для выгрузки
+EXPORT_COLUMNS = (
+    models.Coins.id,
+    models.Coins.description,
+    models.Coins.type_id,
+    models.Type.name.label('type'),
+    models.Coins.currency_id,
+    models.Currency.name.label('currency'),
+    models.Coins.nominal_value,
+    models.Coins.md_id,
+    models.Md.name.label('md'),
+    models.Coins.state_id,
+    models.State.name.label('state'),
+    models.Coins.year,
+    models.Coins.serial_number,
+    models.Coins.user_id,
+)
+
+
+def filter_visible(coins_query, user: Principal):
+    """Администратор видит все монетки, пользователь - только свои"""
+    if not user.is_superuser:
+        coins_query = coins_query.where(models.Coins.user_id == user.id)
+    return coins_query
+
+
+class CoinFilters(NamedTuple):
+    type_id: int | None
+    currency_id: int | None
+    md_id: int | None
+    state_id: int | None
+    year_from: int | None
+    year_to: int | None
+    serial_number: str | None
+    search: str | None
+
+
+async def coin_filters(type_id: int | None = None,
+                       currency_id: int | None = None,
+                       md_id: int | None = None,
+                       state_id: int | None = None,
+                       year_from: int | None = None,
+                       year_to: int | None = None,
+                       serial_number: str | None = None,
+                       search: str | None = None):
+    return CoinFilters(type_id, currency_id, md_id, state_id, year_from,
+                       year_to, serial_number, search)
+
+
+def apply_filters(coins_query, filters: CoinFilters, dialect_name: str):
+    """Отбор монеток по параметрам запроса"""
+    for field in ('type_id', 'currency_id', 'md_id', 'state_id'):
+        value = getattr(filters, field)
+        if value is not None:
+            coins_query = coins_query.where(
+                getattr(models.Coins, field) == value)
+    # Год хранится строкой и сравнивается числом: '500' < '1000'
+    if filters.year_from is not None or filters.year_to is not None:
+        year = models.coins_year_number(dialect_name)
+        if filters.year_from is not None:
+            coins_query = coins_query.where(year >= filters.year_from)
+        if filters.year_to is not None:
+            coins_query = coins_query.where(year <= filters.year_to)
+    if filters.serial_number:
+        coins_query = coins_query.where(models.Coins.serial_number.startswith(
+            filters.serial_number, autoescape=True))
+    if filters.search and filters.search.strip():
+        coins_query = coins_query.where(
+            models.coins_search_clause(dialect_name, filters.search))
+    return coins_query
+
+
+async def get_coin_with_relations(db: AsyncSession, id: int):
+    result = await db.execute(
+        select(models.Coins).options(*models.COIN_LOAD_OPTIONS).where(
+            models.Coins.id == id).execution_options(populate_existing=True))
+    return result.scalars().first()
+
 
 @router.post('/', status_code=status.HTTP_201_CREATED,
              response_model=schemas.CoinResponse)
-def create_coin(coin: schemas.CoinsBase, db: Session = Depends(get_db),
-                owner_id: str = Depends(require_user)):
-    coin.user_id = owner_id
+async def create_coin(coin: schemas.CoinsBase,
+                      db: AsyncSession = Depends(get_db),
+                      owner: Principal = Depends(require_user)):
+    coin.user_id = owner.id
     new_coin = models.Coins(**coin.dict())
     try:
         db.add(new_coin)
-        db.commit()
-        db.refresh(new_coin)
+        await db.flush()
+        new_coin_id = new_coin.id
+        await db.commit()
     except IntegrityError:
         raise HTTPException(status_code=404, detail="Not valid data")
-    return new_coin
+    return await get_coin_with_relations(db, new_coin_id)
+
 
+@router.get('/', response_model=schemas.ListCoins,
+            response_class=ORJSONResponse)
+async def get_coins(request: Request,
+                    limit: int = Query(settings.COINS_PAGE_SIZE, ge=1,
+                                       le=settings.COINS_PAGE_SIZE_MAX),
+                    after: str | None = None,
+                    filters: CoinFilters = Depends(coin_filters),
+                    db: AsyncSession = Depends(get_db),
+                    user: Principal = Depends(require_user)):
+    etag = make_etag(user, request.url.query, await coins_versions(db, user))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    body = await coins_cache.get(etag)
+    if body is not None:
+        return Response(body, media_type='application/json',
+                        headers={'ETag': etag})
+    coins_query = apply_filters(filter_visible(coin_serializer.select(), user),
+                                filters, db.bind.dialect.name)
+    if after:
+        coins_query = coins_query.where(
+            models.Coins.id > decode_cursor(after))
+    result = await db.execute(
+        coins_query.order_by(models.Coins.id).limit(limit + 1))
+    rows = result.all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    response = ORJSONResponse({
+        'status': 'success', 'results': len(rows), 'next_cursor': next_cursor,
+        'coins': [coin_serializer(row) for row in rows]},
+        headers={'ETag': etag})
+    await coins_cache.set(etag, response.body)
+    return response
 
-@router.get('/', response_model=schemas.ListCoins)
-def get_coins(db: Session = Depends(get_db),
-              user_id: str = Depends(require_user)):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+
+@router.get('/stats', response_model=schemas.CoinStats)
+async def get_coin_stats(db: AsyncSession = Depends(get_db),
+                         user: Principal = Depends(require_user)):
+    # Суперпользователю - сумма по слотам, а не по всем пользователям
     if user.is_superuser:
-        coins = db.query(models.Coins).all()
+        counters = models.CoinStatsTotal
+        stats_query = select(
+            counters.dimension, counters.value, func.sum(counters.count)
+        ).group_by(counters.dimension, counters.value)
     else:
-        coins = db.query(models.Coins).filter(
-            models.Coins.user_id == user.id).all()
-    return {'status': 'success', 'results': len(coins), 'coins': coins}
+        counters = models.CoinStats
+        stats_query = select(
+            counters.dimension, counters.value, counters.count
+        ).where(counters.user_id == user.id)
+    stats_query = stats_query.where(counters.count > 0)
+    result = await db.execute(stats_query)
+    stats = {dimension: [] for dimension in models.STATS_DIMENSIONS}
+    for dimension, value, count in result:
+        if dimension == 'year':
+            stats['year'].append({'year': value or None, 'count': count})
+        else:
+            stats[dimension].append({'id': int(value) if value else None,
+                                     'count': count})
+    for items in stats.values():
+        items.sort(key=lambda item: -item['count'])
+    return {'status': 'success',
+            'total': sum(item['count'] for item in stats['type']),
+            **stats}
 
 
-@router.put('/{id}', response_model=schemas.CoinResponse)
-def update_coin(id: str, coin: schemas.CoinsBase,
-                db: Session = Depends(get_db),
-                user_id: str = Depends(require_user)):
-    coin_query = db.query(models.Coins).filter(models.Coins.id == id)
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    updated_coin = coin_query.first()
-    if not updated_coin:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'No coin with this id: {id}')
-    if user.is_superuser or updated_coin.user_id == user.id:
+@router.get('/export')
+async def export_coins(format: str = Query('ndjson', regex='^(ndjson|csv)$'),
+                       filters: CoinFilters = Depends(coin_filters),
+                       db: AsyncSession = Depends(get_db),
+                       user: Principal = Depends(require_user)):
+    coins_query = apply_filters(filter_visible(
+        select(*EXPORT_COLUMNS).select_from(models.Coins)
+        .outerjoin(models.Coins.type).outerjoin(models.Coins.currency)
+        .outerjoin(models.Coins.md).outerjoin(models.Coins.state), user),
+        filters, db.bind.dialect.name)
+    result = await db.stream(
+        coins_query.order_by(models.Coins.id).execution_options(
+            yield_per=settings.COINS_EXPORT_CHUNK_SIZE))
+
+    async def ndjson_rows():
+        async for rows in result.mappings().partitions():
+            yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n'
+                          for row in rows)
+
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(result.keys())
+        async for rows in result.partitions():
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if format == 'csv':
+        content, media_type = csv_rows(), 'text/csv'
+    else:
+        content, media_type = ndjson_rows(), 'application/x-ndjson'
+    return StreamingResponse(content, media_type=media_type, headers={
+        'Content-Disposition': f'attachment; filename="coins.{format}"'})
+
+
+# Пакетные операции: один запрос на операцию и одна транзакция на пакет
+COIN_REFERENCES = (
+    ('type_id', models.Type),
+    ('currency_id', models.Currency),
+    ('md_id', models.Md),
+    ('state_id', models.State),
+    ('user_id', models.User),
+)
+
+
+def check_batch_size(items):
+    if len(items) > settings.COINS_BATCH_SIZE_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'Batch is limited to {settings.COINS_BATCH_SIZE_MAX} '
+                   f'items')
+
+
+async def get_missing_references(db: AsyncSession, coins):
+    """Ссылки на несуществующие записи, по номеру элемента пакета"""
+    selects = []
+    for field, model in COIN_REFERENCES:
+        ids = {getattr(coin, field) for coin in coins} - {None}
+        if ids:
+            selects.append(select(literal_column(f"'{field}'"), model.id)
+                           .where(model.id.in_(ids)))
+    existing = set()
+    if selects:
+        result = await db.execute(union_all(*selects))
+        existing = {tuple(row) for row in result}
+    missing = {}
+    for index, coin in enumerate(coins):
+        for field, _ in COIN_REFERENCES:
+            value = getattr(coin, field)
+            if value is not None and (field, value) not in existing:
+                missing[index] = f'No {field} with this id: {value}'
+                break
+    return missing
+
+
+async def get_coin_owners(db: AsyncSession, ids):
+    result = await db.execute(
+        select(models.Coins.id, models.Coins.user_id).where(
+            models.Coins.id.in_(set(ids))))
+    return dict(result.all())
+
+
+async def insert_batch(db: AsyncSession, rows):
+    """Вставка строк пакета, возвращает id новых монеток по порядку"""
+    coins_table = models.Coins.__table__
+    if db.bind.dialect.full_returning:
+        result = await db.execute(
+            insert(coins_table).values(rows).returning(coins_table.c.id))
+        return result.scalars().all()
+    new_ids = []
+    for row in rows:
+        result = await db.execute(insert(coins_table).values(row))
+        new_ids.append(result.inserted_primary_key[0])
+    return new_ids
+
+
+# Запись справочника могут удалить между проверкой ссылок и записью
+# пакета - тогда пакет проверяется и записывается заново, а после
+# BATCH_ATTEMPTS неудач все его элементы считаются ошибками
+BATCH_ATTEMPTS = 3
+
+
+@router.post('/batch', response_model=schemas.BatchResult)
+async def create_coins_batch(coins: List[schemas.CoinsBase],
+                             db: AsyncSession = Depends(get_db),
+                             owner: Principal = Depends(require_user)):
+    check_batch_size(coins)
+    for coin in coins:
+        coin.user_id = owner.id
+    for _ in range(BATCH_ATTEMPTS):
+        missing = await get_missing_references(db, coins)
+        valid = [(index, coin) for index, coin in enumerate(coins)
+                 if index not in missing]
         try:
-            coin_query.update(coin.dict(exclude_unset=True))
+            new_ids = []
+            if valid:
+                new_ids = await insert_batch(
+                    db, [coin.dict() for _, coin in valid])
+            await db.commit()
         except IntegrityError:
-            raise HTTPException(status_code=404, detail="Not valid data")
-        db.commit()
-        return updated_coin
+            await db.rollback()
+            continue
+        break
     else:
-        return Response(status_code=status.HTTP_403_FORBIDDEN)
+        missing = dict.fromkeys(range(len(coins)),
+                                'Referenced record was deleted')
+        valid = []
+    results = [schemas.BatchItemResult(index=index, status='error',
+                                       detail=missing[index])
+               for index in missing]
+    results += [schemas.BatchItemResult(index=index, id=new_id,
+                                        status='created')
+                for (index, _), new_id in zip(valid, new_ids)]
+    results.sort(key=lambda item: item.index)
+    return {'status': 'success', 'results': results}
 
 
-@router.delete('/{id}')
-def delete_coin(id: str, db: Session = Depends(get_db),
-                user_id: str = Depends(require_user)):
-    coin_query = db.query(models.Coins).filter(models.Coins.id == id)
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    deleted_coin = coin_query.first()
-    if not deleted_coin:
+async def plan_batch_update(db: AsyncSession, coins, user: Principal):
+    """
+    Результаты пакета изменений и параметры UPDATE, сгруппированные по
+    набору изменяемых полей
+    """
+    owners = await get_coin_owners(db, [coin.id for coin in coins])
+    missing = await get_missing_references(db, coins)
+    results = []
+    statements = {}
+    for index, coin in enumerate(coins):
+        if coin.id not in owners:
+            results.append(schemas.BatchItemResult(
+                index=index, id=coin.id, status='error',
+                detail=f'No coin with this id: {coin.id}'))
+        elif not user.is_superuser and owners[coin.id] != user.id:
+            results.append(schemas.BatchItemResult(
+                index=index, id=coin.id, status='error',
+                detail='Forbidden'))
+        elif index in missing:
+            results.append(schemas.BatchItemResult(
+                index=index, id=coin.id, status='error',
+                detail=missing[index]))
+        else:
+            values = coin.dict(exclude_unset=True, exclude={'id'})
+            if not user.is_superuser:
+                values.pop('user_id', None)
+            values['coin_id'] = coin.id
+            statements.setdefault(frozenset(values), []).append(values)
+            results.append(schemas.BatchItemResult(
+                index=index, id=coin.id, status='updated'))
+    return results, statements
+
+
+async def update_batch(db: AsyncSession, statements, user: Principal):
+    """Один executemany UPDATE на каждый набор изменяемых полей"""
+    coins_table = models.Coins.__table__
+    for params in statements.values():
+        coins_update = update(coins_table).where(
+            coins_table.c.id == bindparam('coin_id'))
+        if not user.is_superuser:
+            coins_update = coins_update.where(
+                coins_table.c.user_id == user.id)
+        await db.execute(coins_update, params)
+
+
+@router.patch('/batch', response_model=schemas.BatchResult)
+async def update_coins_batch(coins: List[schemas.CoinsBatchUpdate],
+                             db: AsyncSession = Depends(get_db),
+                             user: Principal = Depends(require_user)):
+    check_batch_size(coins)
+    if not user.is_superuser:
+        for coin in coins:
+            coin.user_id = None
+    for _ in range(BATCH_ATTEMPTS):
+        results, statements = await plan_batch_update(db, coins, user)
+        try:
+            await update_batch(db, statements, user)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            continue
+        break
+    else:
+        results = [schemas.BatchItemResult(
+            index=index, id=coin.id, status='error',
+            detail='Referenced record was deleted')
+            for index, coin in enumerate(coins)]
+    return {'status': 'success', 'results': results}
+
+
+@router.delete('/batch', response_model=schemas.BatchResult)
+async def delete_coins_batch(data: schemas.CoinsBatchDelete,
+                             db: AsyncSession = Depends(get_db),
+                             user: Principal = Depends(require_user)):
+    check_batch_size(data.ids)
+    owners = await get_coin_owners(db, data.ids)
+    results = []
+    allowed_ids = set()
+    for index, id in enumerate(data.ids):
+        if id not in owners:
+            results.append(schemas.BatchItemResult(
+                index=index, id=id, status='error',
+                detail=f'No coin with this id: {id}'))
+        elif not user.is_superuser and owners[id] != user.id:
+            results.append(schemas.BatchItemResult(
+                index=index, id=id, status='error', detail='Forbidden'))
+        else:
+            allowed_ids.add(id)
+            results.append(schemas.BatchItemResult(
+                index=index, id=id, status='deleted'))
+    if allowed_ids:
+        coins_delete = delete(models.Coins).where(
+            models.Coins.id.in_(allowed_ids))
+        if not user.is_superuser:
+            coins_delete = coins_delete.where(
+                models.Coins.user_id == user.id)
+        await db.execute(coins_delete)
+        await db.commit()
+    return {'status': 'success', 'results': results}
+
+
+def format_validation_error(error: ValidationError):
+    return '; '.join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}"
+                     for item in error.errors())
+
+
+async def load_import_chunk(db: AsyncSession, chunk):
+    """
+    Загрузка проверенной пачки отдельной транзакцией, возвращает число
+    строк и ошибки. Запись справочника могут удалить между проверкой
+    ссылок и вставкой - тогда пачка проверяется и вставляется заново, а
+    после IMPORT_CHUNK_ATTEMPTS неудач все ее строки считаются ошибками
+    """
+    for _ in range(IMPORT_CHUNK_ATTEMPTS):
+        missing = await get_missing_references(
+            db, [coin for _, coin in chunk])
+        errors = [schemas.ImportRowError(row=chunk[index][0], detail=detail)
+                  for index, detail in missing.items()]
+        rows = [coin.dict() for index, (_, coin) in enumerate(chunk)
+                if index not in missing]
+        try:
+            if rows:
+                await insert_coins(db, rows)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            continue
+        return len(rows), errors
+    return 0, [schemas.ImportRowError(row=number,
+                                      detail='Referenced record was deleted')
+               for number, _ in chunk]
+
+
+IMPORT_CHUNK_ATTEMPTS = 3
+
+
+@router.post('/import', response_model=schemas.ImportResult)
+async def import_coins(request: Request,
+                       format: str = Query('ndjson', regex='^(ndjson|csv)$'),
+                       db: AsyncSession = Depends(get_db),
+                       owner: Principal = Depends(require_user)):
+    imported = 0
+    failed = 0
+    errors = []
+    chunk = []
+
+    def add_errors(new_errors):
+        # В ответ попадают первые COINS_IMPORT_MAX_ERRORS ошибок, об
+        # остальных известно только их число
+        nonlocal failed
+        failed += len(new_errors)
+        errors.extend(new_errors[:settings.COINS_IMPORT_MAX_ERRORS -
+                                 len(errors)])
+
+    try:
+        async for number, record, error in iter_records(request.stream(),
+                                                        format):
+            if error is None:
+                record.pop('user_id', None)
+                try:
+                    coin = schemas.CoinsBase.parse_obj(record)
+                except ValidationError as e:
+                    error = format_validation_error(e)
+            if error is not None:
+                add_errors([schemas.ImportRowError(row=number, detail=error)])
+                continue
+            coin.user_id = owner.id
+            chunk.append((number, coin))
+            if len(chunk) >= settings.COINS_IMPORT_CHUNK_SIZE:
+                loaded, chunk_errors = await load_import_chunk(db, chunk)
+                imported += loaded
+                add_errors(chunk_errors)
+                chunk = []
+        if chunk:
+            loaded, chunk_errors = await load_import_chunk(db, chunk)
+            imported += loaded
+            add_errors(chunk_errors)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='File must be UTF-8 encoded')
+    errors.sort(key=lambda item: item.row)
+    return {'status': 'success', 'imported': imported,
+            'failed': failed, 'errors': errors}
+
+
+async def forbidden_or_not_found(db: AsyncSession, id: int):
+    """Ни одна строка не изменена: 403, если монетка есть, иначе 404"""
+    result = await db.execute(
+        select(models.Coins.id).where(models.Coins.id == id))
+    if result.first() is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No coin with this id: {id}')
-    if user.is_superuser or deleted_coin.user_id == user.id:
-        coin_query.delete()
-        db.commit()
-        return Response(status_code=status.HTTP_204_NO_CONTENT)
-    else:
-        return Response(status_code=status.HTTP_403_FORBIDDEN)
+    return Response(status_code=status.HTTP_403_FORBIDDEN)
+
+
+# Проверка владельца входит в условие UPDATE/DELETE; в PostgreSQL
+# изменение и чтение новой монетки со справочниками - один запрос
+@router.put('/{id}', response_model=schemas.CoinResponse)
+async def update_coin(id: int, coin: schemas.CoinsBase,
+                      db: AsyncSession = Depends(get_db),
+                      user: Principal = Depends(require_user)):
+    values = coin.dict(exclude_unset=True)
+    if not user.is_superuser:
+        # Передать монетку другому пользователю может только администратор
+        values.pop('user_id', None)
+    statement = filter_visible(
+        update(models.Coins).where(models.Coins.id == id), user).values(
+        **values)
+    try:
+        if db.bind.dialect.full_returning:
+            updated = statement.returning(*models.Coins.__table__.c).cte(
+                'updated_coin')
+            result = await db.execute(
+                coin_serializer.select(aliased(models.Coins, updated)))
+            updated_coin = result.first()
+        else:
+            result = await db.execute(statement)
+            updated_coin = None
+            if result.rowcount:
+                result = await db.execute(coin_serializer.select().where(
+                    models.Coins.id == id))
+                updated_coin = result.first()
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Not valid data")
+    if updated_coin is None:
+        return await forbidden_or_not_found(db, id)
+    await db.commit()
+    return coin_serializer(updated_coin)
+
+
+@router.delete('/{id}')
+async def delete_coin(id: int, db: AsyncSession = Depends(get_db),
+                      user: Principal = Depends(require_user)):
+    result = await db.execute(filter_visible(
+        delete(models.Coins).where(models.Coins.id == id), user))
+    if not result.rowcount:
+        return await forbidden_or_not_found(db, id)
+    await db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
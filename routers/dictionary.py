@@ -1,177 +1,225 @@
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, status, APIRouter, Response
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, HTTPException, status, APIRouter, Response, \
+    Request
+from fastapi.responses import ORJSONResponse
 
 import schemas
 import models
+from cache import create_cache
+from config import settings
 from database import get_db
+from etags import dictionary_version, is_not_modified, make_etag, \
+    not_modified
+from serializers import RowSerializer
 
 router = APIRouter()
 
+# Списки справочников меняются редко и хранятся в кэше по ETag: ETag
+# меняется с любой записью в справочнике, поэтому сбрасывать кэш не нужно,
+# а список, прочитанный до записи, не попадет под новый ETag
+dictionary_cache = create_cache('dictionary',
+                                2 * len(models.DICTIONARY_TABLES),
+                                settings.DICTIONARY_CACHE_TTL)
+type_serializer = RowSerializer(schemas.Type, models.Type)
+currency_serializer = RowSerializer(schemas.Currency, models.Currency)
+md_serializer = RowSerializer(schemas.Md, models.Md)
+state_serializer = RowSerializer(schemas.State, models.State)
+
+
+async def read_dictionary(request: Request, db: AsyncSession, name: str,
+                          serializer: RowSerializer):
+    """Список справочника с ETag; в кэше хранится по ETag"""
+    etag = make_etag(name, await dictionary_version(db, name))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    items = await dictionary_cache.get(etag)
+    if items is None:
+        result = await db.execute(serializer.select())
+        items = [serializer(row) for row in result]
+        await dictionary_cache.set(etag, items)
+    return ORJSONResponse({name: items}, headers={'ETag': etag})
+
 
 # CRUD типов монет
-@router.get('/type')
-def get_types(db: Session = Depends(get_db)):
-    types = db.query(models.Type).all()
-    return {'type': types}
+@router.get('/type', response_class=ORJSONResponse)
+async def get_types(request: Request, db: AsyncSession = Depends(get_db)):
+    return await read_dictionary(request, db, 'type', type_serializer)
 
 
 @router.post('/type', status_code=status.HTTP_201_CREATED,
              response_model=schemas.Type)
-def create_type(type: schemas.TypeBase, db: Session = Depends(get_db)):
+async def create_type(type: schemas.TypeBase,
+                      db: AsyncSession = Depends(get_db)):
     new_type = models.Type(**type.dict())
     db.add(new_type)
-    db.commit()
-    db.refresh(new_type)
+    await db.commit()
+    await db.refresh(new_type)
     return new_type
 
 
 @router.put('/type/{id}', response_model=schemas.Type)
-def update_type(id: str, type: schemas.TypeBase,
-                db: Session = Depends(get_db)):
-    type_query = db.query(models.Type).filter(models.Type.id == id)
-    updated_type = type_query.first()
+async def update_type(id: int, type: schemas.TypeBase,
+                      db: AsyncSession = Depends(get_db)):
+    type_query = select(models.Type).where(models.Type.id == id)
+    result = await db.execute(type_query)
+    updated_type = result.scalars().first()
     if not updated_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No type with this id: {id}')
-    type_query.update(type.dict(exclude_unset=True))
-    db.commit()
+    await db.execute(
+        update(models.Type).where(models.Type.id == id).values(
+            **type.dict(exclude_unset=True)))
+    await db.commit()
     return updated_type
 
 
 @router.delete('/type/{id}')
-def delete_type(id: str, db: Session = Depends(get_db)):
-    type_query = db.query(models.Type).filter(models.Type.id == id)
-    updated_type = type_query.first()
+async def delete_type(id: int, db: AsyncSession = Depends(get_db)):
+    type_query = select(models.Type).where(models.Type.id == id)
+    result = await db.execute(type_query)
+    updated_type = result.scalars().first()
     if not updated_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No type with this id: {id}')
-    type_query.delete()
-    db.commit()
+    await db.execute(delete(models.Type).where(models.Type.id == id))
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 # CRUD валют
-@router.get('/currency')
-def get_currency(db: Session = Depends(get_db)):
-    currency = db.query(models.Currency).all()
-    return {'currency': currency}
+@router.get('/currency', response_class=ORJSONResponse)
+async def get_currency(request: Request, db: AsyncSession = Depends(get_db)):
+    return await read_dictionary(request, db, 'currency', currency_serializer)
 
 
 @router.post('/currency', status_code=status.HTTP_201_CREATED,
              response_model=schemas.Currency)
-def create_currency(currency: schemas.CurrencyBase,
-                    db: Session = Depends(get_db)):
+async def create_currency(currency: schemas.CurrencyBase,
+                          db: AsyncSession = Depends(get_db)):
     new_currency = models.Currency(**currency.dict())
     db.add(new_currency)
-    db.commit()
-    db.refresh(new_currency)
+    await db.commit()
+    await db.refresh(new_currency)
     return new_currency
 
 
 @router.put('/currency/{id}', response_model=schemas.Currency)
-def update_currency(id: str, currency: schemas.CurrencyBase,
-                    db: Session = Depends(get_db)):
-    currency_query = db.query(models.Currency).filter(models.Currency.id == id)
-    updated_currency = currency_query.first()
+async def update_currency(id: int, currency: schemas.CurrencyBase,
+                          db: AsyncSession = Depends(get_db)):
+    currency_query = select(models.Currency).where(models.Currency.id == id)
+    result = await db.execute(currency_query)
+    updated_currency = result.scalars().first()
     if not updated_currency:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No currency with this id: {id}')
-    currency_query.update(currency.dict(exclude_unset=True))
-    db.commit()
+    await db.execute(
+        update(models.Currency).where(models.Currency.id == id).values(
+            **currency.dict(exclude_unset=True)))
+    await db.commit()
     return updated_currency
 
 
 @router.delete('/currency/{id}')
-def delete_currency(id: str, db: Session = Depends(get_db)):
-    currency_query = db.query(models.Currency).filter(models.Currency.id == id)
-    updated_currency = currency_query.first()
+async def delete_currency(id: int, db: AsyncSession = Depends(get_db)):
+    currency_query = select(models.Currency).where(models.Currency.id == id)
+    result = await db.execute(currency_query)
+    updated_currency = result.scalars().first()
     if not updated_currency:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No currency with this id: {id}')
-    currency_query.delete()
-    db.commit()
+    await db.execute(delete(models.Currency).where(models.Currency.id == id))
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 # CRUD монетный двор
-@router.get('/md')
-def get_md(db: Session = Depends(get_db)):
-    md = db.query(models.Md).all()
-    return {'md': md}
+@router.get('/md', response_class=ORJSONResponse)
+async def get_md(request: Request, db: AsyncSession = Depends(get_db)):
+    return await read_dictionary(request, db, 'md', md_serializer)
 
 
 @router.post('/md', status_code=status.HTTP_201_CREATED,
              response_model=schemas.Md)
-def create_md(md: schemas.MdBase, db: Session = Depends(get_db)):
+async def create_md(md: schemas.MdBase,
+                    db: AsyncSession = Depends(get_db)):
     new_md = models.Md(**md.dict())
     db.add(new_md)
-    db.commit()
-    db.refresh(new_md)
+    await db.commit()
+    await db.refresh(new_md)
     return new_md
 
 
 @router.put('/md/{id}', response_model=schemas.Md)
-def update_md(id: str, md: schemas.CurrencyBase,
-              db: Session = Depends(get_db)):
-    md_query = db.query(models.Md).filter(models.Md.id == id)
-    updated_md = md_query.first()
+async def update_md(id: int, md: schemas.CurrencyBase,
+                    db: AsyncSession = Depends(get_db)):
+    md_query = select(models.Md).where(models.Md.id == id)
+    result = await db.execute(md_query)
+    updated_md = result.scalars().first()
     if not updated_md:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No md with this id: {id}')
-    md_query.update(md.dict(exclude_unset=True))
-    db.commit()
+    await db.execute(
+        update(models.Md).where(models.Md.id == id).values(
+            **md.dict(exclude_unset=True)))
+    await db.commit()
     return updated_md
 
 
 @router.delete('/md/{id}')
-def delete_md(id: str, db: Session = Depends(get_db)):
-    md_query = db.query(models.Md).filter(models.Md.id == id)
-    updated_md = md_query.first()
+async def delete_md(id: int, db: AsyncSession = Depends(get_db)):
+    md_query = select(models.Md).where(models.Md.id == id)
+    result = await db.execute(md_query)
+    updated_md = result.scalars().first()
     if not updated_md:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No md with this id: {id}')
-    md_query.delete()
-    db.commit()
+    await db.execute(delete(models.Md).where(models.Md.id == id))
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 # CRUD выпускающее государство
-@router.get('/state')
-def get_state(db: Session = Depends(get_db)):
-    state = db.query(models.State).all()
-    return {'state': state}
+@router.get('/state', response_class=ORJSONResponse)
+async def get_state(request: Request, db: AsyncSession = Depends(get_db)):
+    return await read_dictionary(request, db, 'state', state_serializer)
 
 
 @router.post('/state', status_code=status.HTTP_201_CREATED,
              response_model=schemas.State)
-def create_state(state: schemas.StateBase, db: Session = Depends(get_db)):
+async def create_state(state: schemas.StateBase,
+                       db: AsyncSession = Depends(get_db)):
     new_state = models.State(**state.dict())
     db.add(new_state)
-    db.commit()
-    db.refresh(new_state)
+    await db.commit()
+    await db.refresh(new_state)
     return new_state
 
 
 @router.put('/state/{id}', response_model=schemas.State)
-def update_state(id: str, state: schemas.StateBase,
-                 db: Session = Depends(get_db)):
-    state_query = db.query(models.State).filter(models.State.id == id)
-    updated_state = state_query.first()
+async def update_state(id: int, state: schemas.StateBase,
+                       db: AsyncSession = Depends(get_db)):
+    state_query = select(models.State).where(models.State.id == id)
+    result = await db.execute(state_query)
+    updated_state = result.scalars().first()
     if not updated_state:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No state with this id: {id}')
-    state_query.update(state.dict(exclude_unset=True))
-    db.commit()
+    await db.execute(
+        update(models.State).where(models.State.id == id).values(
+            **state.dict(exclude_unset=True)))
+    await db.commit()
     return updated_state
 
 
 @router.delete('/state/{id}')
-def delete_state(id: str, db: Session = Depends(get_db)):
-    state_query = db.query(models.State).filter(models.State.id == id)
-    updated_state = state_query.first()
+async def delete_state(id: int, db: AsyncSession = Depends(get_db)):
+    state_query = select(models.State).where(models.State.id == id)
+    result = await db.execute(state_query)
+    updated_state = result.scalars().first()
     if not updated_state:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f'No state with this id: {id}')
-    state_query.delete()
-    db.commit()
+    await db.execute(delete(models.State).where(models.State.id == id))
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -1,23 +1,18 @@
-from passlib.context import CryptContext
 from datetime import timedelta
 from fastapi import APIRouter, Request, Response, status, Depends, \
     HTTPException
+from fastapi_jwt_auth.exceptions import AuthJWTException
 
 import schemas, models
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
-from oauth2 import AuthJWT
+from oauth2 import AuthJWT, Principal, require_user
 from config import settings
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def hash_password(password: str):
-    return pwd_context.hash(password)
-
-
-def verify_password(password: str, hashed_password: str):
-    return pwd_context.verify(password, hashed_password)
+from passwords import hash_password, verify_password
+from revocation import denylist, issued_claims, revoke_tokens, \
+    revoke_user_tokens
 
 
 router = APIRouter()
@@ -26,41 +21,52 @@ REFRESH_TOKEN_EXPIRES_IN = settings.REFRESH_TOKEN_EXPIRES_IN
 
 
 @router.post('/register', status_code=status.HTTP_201_CREATED)
-def create_user(data: schemas.UserLoginCreate,
-                db: Session = Depends(get_db)):
-    user_query = db.query(models.User).filter(
+async def create_user(data: schemas.UserLoginCreate,
+                      db: AsyncSession = Depends(get_db)):
+    user_query = select(models.User).where(
         models.User.username == data.username)
-    user = user_query.first()
+    result = await db.execute(user_query)
+    user = result.scalars().first()
     if user:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail='This username already exist')
-    data.password = hash_password(data.password)
+    data.password = await hash_password(data.password)
     new_user = models.User(**data.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Имя успел занять параллельный запрос
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail='This username already exist')
     return {'status': 'success', 'message': 'user created'}
 
 
 @router.post('/login')
-def login(data: schemas.UserLoginCreate, response: Response,
-          db: Session = Depends(get_db), Authorize: AuthJWT = Depends()):
-    user = db.query(models.User).filter(
-        models.User.username == data.username).first()
+async def login(data: schemas.UserLoginCreate, response: Response,
+                db: AsyncSession = Depends(get_db),
+                Authorize: AuthJWT = Depends()):
+    result = await db.execute(select(models.User).where(
+        models.User.username == data.username))
+    user = result.scalars().first()
     if not user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail='Incorrect username or password')
 
-    if not verify_password(data.password, user.password):
+    verified, new_hash = await verify_password(data.password, user.password)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail='Incorrect username or password')
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
 
     access_token = Authorize.create_access_token(
-        subject=str(user.id),
+        subject=str(user.id), user_claims=issued_claims(),
         expires_time=timedelta(minutes=ACCESS_TOKEN_EXPIRES_IN))
 
     refresh_token = Authorize.create_refresh_token(
-        subject=str(user.id),
+        subject=str(user.id), user_claims=issued_claims(),
         expires_time=timedelta(minutes=REFRESH_TOKEN_EXPIRES_IN))
 
     response.set_cookie('access_token', access_token,
@@ -79,21 +85,24 @@ def login(data: schemas.UserLoginCreate, response: Response,
 
 
 @router.get('/refresh')
-def refresh_token(response: Response, request: Request,
-                  Authorize: AuthJWT = Depends(),
-                  db: Session = Depends(get_db)):
+async def refresh_token(response: Response, request: Request,
+                        Authorize: AuthJWT = Depends(),
+                        db: AsyncSession = Depends(get_db)):
+    await denylist.sync(db)
     try:
         Authorize.jwt_refresh_token_required()
         user_id = Authorize.get_jwt_subject()
         if not user_id:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                 detail='Could not refresh access token')
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        result = await db.execute(
+            select(models.User).where(models.User.id == int(user_id)))
+        user = result.scalars().first()
         if not user:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                 detail='The user belonging to this token no logger exist')
         access_token = Authorize.create_access_token(
-            subject=str(user.id),
+            subject=str(user.id), user_claims=issued_claims(),
             expires_time=timedelta(minutes=ACCESS_TOKEN_EXPIRES_IN))
     except Exception as e:
         error = e.__class__.__name__
@@ -114,8 +123,40 @@ def refresh_token(response: Response, request: Request,
     return {'access_token': access_token}
 
 
+def verified_claims(Authorize: AuthJWT, token: str | None):
+    """Claims действующего токена или None"""
+    try:
+        return Authorize.get_raw_jwt(token)
+    except AuthJWTException:
+        return None
+
+
 @router.get('/logout', status_code=status.HTTP_200_OK)
-def logout(response: Response, Authorize: AuthJWT = Depends()):
+async def logout(response: Response, request: Request,
+                 Authorize: AuthJWT = Depends(),
+                 db: AsyncSession = Depends(get_db)):
+    # Токены отзываются, чтобы их копии нельзя было использовать после
+    # выхода; None - токен из заголовка Authorization
+    tokens = (None, request.cookies.get('access_token'),
+              request.cookies.get('refresh_token'))
+    claims = {item['jti']: item for item in (
+        verified_claims(Authorize, token) for token in tokens) if item}
+    await revoke_tokens(db, claims.values())
     Authorize.unset_jwt_cookies()
     response.set_cookie('logged_in', '', -1)
     return {'status': 'success'}
+
+
+@router.post('/{id}/revoke-tokens', status_code=status.HTTP_200_OK)
+async def revoke_all_tokens(id: int, db: AsyncSession = Depends(get_db),
+                            user: Principal = Depends(require_user)):
+    """Отзыв всех токенов пользователя: своих или, для админа, любого"""
+    if id != user.id and not user.is_superuser:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail='Not enough permissions')
+    try:
+        await revoke_user_tokens(db, id)
+    except IntegrityError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'User with id: {id} not found')
+    return {'status': 'success'}
@@ -75,6 +75,14 @@ class CoinsBase(BaseModel):
     user_id: int | None = None
 
 
+class CoinsBatchUpdate(CoinsBase):
+    id: int
+
+
+class CoinsBatchDelete(BaseModel):
+    ids: List[int]
+
+
 class CoinResponse(BaseModel):
     id: int
     description: str
@@ -94,4 +102,48 @@ class CoinResponse(BaseModel):
 class ListCoins(BaseModel):
     status: str
     results: int
+    next_cursor: str | None = None
     coins: List[CoinResponse]
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    id: int | None = None
+    status: str
+    detail: str | None = None
+
+
+class BatchResult(BaseModel):
+    status: str
+    results: List[BatchItemResult]
+
+
+class ImportRowError(BaseModel):
+    row: int
+    detail: str
+
+
+class ImportResult(BaseModel):
+    status: str
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+
+
+class DictionaryStats(BaseModel):
+    id: int | None
+    count: int
+
+
+class YearStats(BaseModel):
+    year: str | None
+    count: int
+
+
+class CoinStats(BaseModel):
+    status: str
+    total: int
+    type: List[DictionaryStats]
+    currency: List[DictionaryStats]
+    state: List[DictionaryStats]
+    year: List[YearStats]
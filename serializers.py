@@ -0,0 +1,57 @@
+from operator import itemgetter
+
+from pydantic import BaseModel
+from sqlalchemy import select
+
+
+class RowSerializer:
+    """
+    Сборка ответа по схеме pydantic прямо из строк запроса, без создания
+    объектов ORM и проверки каждого объекта схемой. Вложенные схемы
+    читаются через LEFT JOIN по одноименным связям модели
+    """
+
+    def __init__(self, schema, model):
+        self.model = model
+        # (модель или None для основной записи, атрибут, метка колонки)
+        self.columns = []
+        self.relationships = []
+        self._serialize = self._build(schema, None, model, '')
+
+    def _build(self, schema, owner, model, prefix):
+        fields = []
+        for name, field in schema.__fields__.items():
+            if isinstance(field.type_, type) and issubclass(field.type_,
+                                                            BaseModel):
+                related = getattr(model, name).property.mapper.class_
+                self.relationships.append((owner, name))
+                fields.append((name, self._build(
+                    field.type_, related, related, f'{prefix}{name}__')))
+            else:
+                self.columns.append((owner, name, f'{prefix}{name}'))
+                fields.append((name, itemgetter(len(self.columns) - 1)))
+        # Связанной записи нет, если ее id (или первое поле) пусто
+        key = dict(fields).get('id', fields[0][1])
+
+        def serialize(row):
+            if prefix and key(row) is None:
+                return None
+            return {name: getter(row) for name, getter in fields}
+
+        return serialize
+
+    def select(self, source=None):
+        """
+        Запрос колонок схемы; source - псевдоним модели, например над CTE
+        с UPDATE ... RETURNING
+        """
+        source = source or self.model
+        query = select(*(
+            getattr(owner or source, name).label(label)
+            for owner, name, label in self.columns)).select_from(source)
+        for owner, name in self.relationships:
+            query = query.outerjoin(getattr(owner or source, name))
+        return query
+
+    def __call__(self, row):
+        return self._serialize(row)
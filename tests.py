@@ -1,54 +1,234 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+
 import pytest
+import fakeredis
+import fakeredis.aioredis
+from anyio.from_thread import start_blocking_portal
+from fastapi_jwt_auth import auth_jwt
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from passlib.context import CryptContext
+from pydantic import ValidationError
+from sqlalchemy import create_engine, event, func, insert, inspect, select, \
+    text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+import metrics
+import models
+import schemas
 from database import get_db, Base
 from fake_data_db_test.fill_db import fill_db_fake_data
+from fake_data_db_test.generate import create_coin_indexes, \
+    drop_coin_indexes, iter_coin_batches
+from cache import create_cache, BYTES_CODEC, MemoryCache, RedisCache, \
+    SQLiteCache, TTLCache
+from config import settings, Settings
 from main import app
+from oauth2 import claims_cache, principal_cache, ClaimsCache, Principal, \
+    PRINCIPAL_CODEC
+from routers.coin import coin_serializer, coins_cache, filter_visible
+from routers import coin as coin_router, dictionary
+from routers.dictionary import dictionary_cache
+from revocation import denylist, Denylist
+
+# Схему тестовой базы создают фикстуры, а не запуск приложения
+settings.DB_INIT_ON_STARTUP = False
+
+# Схема и данные создаются один раз за сессию, каждый тест выполняется в
+# транзакции на одном соединении и откатывается. TEST_DB_MEMORY=1 держит
+# базу в памяти; при запуске через pytest-xdist у каждого процесса свой файл
+if os.environ.get('TEST_DB_MEMORY') == '1':
+    TEST_DB_FILE = None
+    async_engine = create_async_engine("sqlite+aiosqlite://",
+                                       poolclass=StaticPool)
+else:
+    TEST_DB_FILE = "./test_db{}.db".format(
+        f"_{os.environ['PYTEST_XDIST_WORKER']}"
+        if 'PYTEST_XDIST_WORKER' in os.environ else '')
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_FILE}")
+LARGE_DB_SIZE = 2000
+# Тесты триггеров PostgreSQL выполняются, только если задана эта база
+TEST_POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE', 'ROLLBACK')
+
+
+@event.listens_for(async_engine.sync_engine, 'connect')
+def disable_driver_transactions(dbapi_connection, connection_record):
+    # Драйвер sqlite сам начинает и завершает транзакции и ломает SAVEPOINT
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(async_engine.sync_engine, 'begin')
+def begin_transaction(connection):
+    connection.exec_driver_sql('BEGIN')
+
+
+def bind_session(connection):
+    """
+    Сессия на соединении теста: commit и rollback в ней завершают только
+    SAVEPOINT, который сразу открывается заново
+    """
+    session = AsyncSession(bind=connection, autoflush=False,
+                           expire_on_commit=False)
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test_db.db"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionTesting = sessionmaker(autocommit=False, autoflush=False,
-                              bind=engine)
+    @event.listens_for(session.sync_session, 'after_transaction_end')
+    def restart_savepoint(sync_session, transaction):
+        if not connection.closed and not connection.in_nested_transaction():
+            connection.sync_connection.begin_nested()
 
+    return session
 
-@pytest.fixture(scope="function")
-def app_start():
+
+def create_test_database(connection):
+    Base.metadata.create_all(connection)
+    fill_db_fake_data("fake_data_db_test/fake_tests_data.json",
+                      Session(bind=connection))
+
+
+def clear_caches(*caches):
+    """Сброс кэшей; кэши в памяти не привязаны к циклу событий приложения"""
+    async def clear():
+        for cache in caches:
+            await cache.clear()
+
+    asyncio.run(clear())
+
+
+def remove_test_db_file():
+    if TEST_DB_FILE and os.path.exists(TEST_DB_FILE):
+        os.remove(TEST_DB_FILE)
+
+
+@pytest.fixture(scope="session")
+def db_portal():
+    """Цикл событий для работы тестов с базой вне TestClient"""
+    with start_blocking_portal() as portal:
+        yield portal
+
+
+@pytest.fixture(scope="session")
+def app_start(db_portal):
     """
-    Создание новой базы для тестированя и ее удаление после каждого теста
+    Создание базы для тестирования, наполнение ее данными и удаление
+    после всех тестов
     """
-    Base.metadata.create_all(engine)
+
+    async def create():
+        async with async_engine.begin() as connection:
+            await connection.run_sync(create_test_database)
+
+    remove_test_db_file()
+    db_portal.call(create)
     yield app
-    Base.metadata.drop_all(engine)
+    db_portal.call(async_engine.dispose)
+    remove_test_db_file()
+
+
+@pytest.fixture(scope="function")
+def db_connection(app_start, db_portal):
+    """
+    Соединение с транзакцией, которая откатывается после теста
+    """
+
+    async def connect():
+        connection = await async_engine.connect()
+        transaction = await connection.begin()
+        await connection.begin_nested()
+        return connection, transaction
+
+    connection, transaction = db_portal.call(connect)
+    yield connection
+    db_portal.call(transaction.rollback)
+    db_portal.call(connection.close)
 
 
 @pytest.fixture(scope="function")
-def db_session(app_start):
+def db_session(db_connection, db_portal):
     """
-    Подключение к тестовой базе и наполнениение ее даными
+    Сессия тестовой базы внутри транзакции теста
     """
-    connection = engine.connect()
-    session = SessionTesting(bind=connection)
-    fill_db_fake_data("fake_data_db_test/fake_tests_data.json", session)
+    session = bind_session(db_connection)
     yield session
+    db_portal.call(session.close)
+
+
+@pytest.fixture(scope="function")
+def run(db_portal):
+    """Выполнение корутины из теста: run(db_session.commit())"""
+    return lambda awaitable: db_portal.call(lambda: awaitable)
+
+
+@pytest.fixture(scope="function")
+def large_db(db_session, run):
+    """
+    Наполнение тестовой базы большим числом монеток разных пользователей
+    """
+    coin = {
+        "type_id": 1,
+        "currency_id": 2,
+        "nominal_value": "100",
+        "md_id": 3,
+        "state_id": 1,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    run(db_session.execute(insert(models.Coins), [
+        dict(coin, description=f"coin {index}", user_id=index % 3 + 1)
+        for index in range(LARGE_DB_SIZE)]))
+    run(db_session.commit())
+    yield db_session
+
+
+@contextmanager
+def query_budget(max_queries):
+    """
+    Подсчет SQL-запросов к тестовой базе внутри блока; тест падает,
+    если их больше max_queries. Кеш пользователей сбрасывается, чтобы
+    в бюджет входила проверка токена
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context,
+                        executemany):
+        statements.append(statement)
+
+    clear_caches(principal_cache)
+    event.listen(async_engine.sync_engine, 'before_cursor_execute',
+                 count_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, 'before_cursor_execute',
+                     count_statement)
+    queries = [statement for statement in statements
+               if not statement.startswith(TRANSACTION_STATEMENTS)]
+    assert len(queries) <= max_queries, '\n'.join(queries)
 
 
 @pytest.fixture(scope="function")
-def client(app_start, db_session):
+def client(app_start, db_connection):
     """
     Создание TestClient с подключением к тестовой базе
     """
 
-    def get_db_test():
-        db = SessionTesting()
+    async def get_db_test():
+        db = bind_session(db_connection)
         try:
             yield db
         finally:
-            pass
+            await db.close()
 
     app.dependency_overrides[get_db] = get_db_test
+    clear_caches(dictionary_cache, principal_cache, coins_cache)
+    claims_cache.cache.clear()
+    # Отзывы прошлых тестов откатились вместе с их транзакциями
+    denylist.clear(loaded=True)
     with TestClient(app) as client:
         yield client
 
@@ -127,6 +307,19 @@ def test_user_create_user_already_exists(client):
     assert response.status_code == 409
 
 
+def test_make_username_unique(db_connection, run):
+    """Обычный индекс имен из старых баз заменяется уникальным"""
+    def rebuild(connection):
+        connection.execute(text('DROP INDEX ix_user_username'))
+        connection.execute(text(
+            'CREATE INDEX ix_user_username ON user (username)'))
+        models.make_username_unique(connection)
+        return {index['name']: index['unique'] for index
+                in inspect(connection).get_indexes('user')}
+
+    assert run(db_connection.run_sync(rebuild))['ix_user_username']
+
+
 def test_user_login(client):
     """
         Логин пользователя
@@ -142,6 +335,42 @@ def test_user_login(client):
     assert response.cookies.get('logged_in') == 'True'
 
 
+def test_user_login_rehash(client, db_session, run):
+    """
+        Пересчет хэша пароля со старым числом раундов при входе
+    """
+    request_data = {
+        "username": "test",
+        "is_superuser": False,
+        "password": "test"
+    }
+    client.post("/api/user/register", json=request_data)
+    user = run(db_session.scalar(select(models.User).where(
+        models.User.username == 'test')))
+    user.password = CryptContext(
+        schemes=["bcrypt"], bcrypt__default_rounds=4).hash("test")
+    run(db_session.commit())
+
+    response = client.post("/api/user/login", json=request_data)
+    assert response.status_code == 200
+    run(db_session.refresh(user))
+    assert user.password.startswith(f"$2b${settings.BCRYPT_ROUNDS:02d}$")
+
+
+def test_user_login_busy(client, monkeypatch):
+    """
+        Отказ при переполнении очереди хэширования паролей
+    """
+    monkeypatch.setattr(settings, "PASSWORD_HASH_MAX_PENDING", 0)
+    request_data = {
+        "username": "test",
+        "is_superuser": False,
+        "password": "test"
+    }
+    response = client.post("/api/user/register", json=request_data)
+    assert response.status_code == 503
+
+
 def test_user_logout(client):
     """
             Логаут пользователя
@@ -157,6 +386,103 @@ def test_user_logout(client):
     assert response.status_code == 200
 
 
+def test_user_logout_revokes_tokens(client, db_session, run):
+    """После выхода старые access и refresh токены не принимаются"""
+    cookies = get_cookies_user(client)
+    client.cookies = cookies
+    assert client.get("/api/coins").status_code == 200
+    response = client.get("/api/user/logout")
+    assert response.status_code == 200
+
+    client.cookies = cookies
+    assert client.get("/api/coins").status_code == 401
+    response = client.get("/api/user/refresh")
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'RevokedTokenError'
+    # Другой воркер узнает об отзыве из базы
+    other = Denylist(sync_interval=0)
+    run(other.sync(db_session))
+    jtis = run(db_session.scalars(select(models.RevokedToken.jti))).all()
+    assert len(jtis) == 2 and set(jtis) == set(other.tokens)
+
+
+def test_user_revoke_all_tokens(client, db_session, run):
+    """Отзыв всех токенов пользователя: свои может он сам, чужие - админ"""
+    client.cookies = get_cookies_user(client)
+    user = run(db_session.scalar(select(models.User).where(
+        models.User.username == 'test')))
+    response = client.post("/api/user/1/revoke-tokens")
+    assert response.status_code == 403
+    response = client.post(f"/api/user/{user.id}/revoke-tokens")
+    assert response.status_code == 200
+    assert client.get("/api/coins").status_code == 401
+
+    other = Denylist(sync_interval=0)
+    run(other.sync(db_session))
+    now = int(time.time())
+    assert other.is_revoked({'sub': str(user.id), 'iat': now - 10})
+    assert not other.is_revoked({'sub': str(user.id), 'iat': now + 10})
+    assert not other.is_revoked({'sub': '1', 'iat': now - 10})
+
+
+def test_user_relogin_after_revoke(client, db_session, run):
+    """
+    Токены повторного входа в ту же секунду, что и отзыв всех токенов,
+    действуют: время выдачи сравнивается с долями секунды
+    """
+    client.cookies = get_cookies_user(client)
+    user = run(db_session.scalar(select(models.User).where(
+        models.User.username == 'test')))
+    # Отзыв и вход в начале одной секунды, как при целых iat
+    time.sleep(1 - time.time() % 1)
+    response = client.post(f"/api/user/{user.id}/revoke-tokens")
+    assert response.status_code == 200
+    assert client.get("/api/coins").status_code == 401
+    client.cookies = get_cookies_user(client)
+    assert client.get("/api/coins").status_code == 200
+
+    revoked_at = denylist.users[user.id][0]
+    assert denylist.is_revoked({'sub': str(user.id), 'iat': int(revoked_at),
+                                'issued_at': revoked_at - 0.1})
+    assert not denylist.is_revoked({'sub': str(user.id),
+                                    'iat': int(revoked_at),
+                                    'issued_at': revoked_at + 0.1})
+
+
+def test_jwt_claims_cached(client, monkeypatch):
+    """Подпись токена проверяется один раз, дальше claims берутся из кэша"""
+    client.cookies = get_cookies_user(client)
+    decode = auth_jwt.jwt.decode
+    calls = []
+
+    def counting_decode(*args, **kwargs):
+        calls.append(args[0])
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(auth_jwt.jwt, 'decode', counting_decode)
+    assert client.get("/api/coins").status_code == 200
+    assert calls
+    calls.clear()
+    assert client.get("/api/coins").status_code == 200
+    assert calls == []
+
+
+def test_jwt_claims_cache_expiry_and_rotation():
+    cache = ClaimsCache(maxsize=10, ttl=60)
+    claims = {'sub': '1', 'type': 'access', 'exp': time.time() + 60}
+    assert cache.get('token', None, 'key') is None
+    cache.set('token', None, 'key', claims)
+    assert cache.get('token', None, 'key') == claims
+    assert cache.get('token', 'issuer', 'key') is None
+    cache.set('expired', None, 'key', dict(claims, exp=time.time() - 1))
+    assert cache.get('expired', None, 'key') is None
+    # Смена ключа сбрасывает все проверенные токены
+    assert cache.get('token', None, 'new key') is None
+    cache.set('other', None, 'new key', claims)
+    assert cache.get('token', None, 'new key') is None
+    assert cache.get('other', None, 'new key') == claims
+
+
 # Тестирование CRUD операций со словарями
 def test_dict_post(client):
     """
@@ -203,6 +529,27 @@ def test_dict_get(client):
     assert len(response.json().get('state')) == 3
 
 
+def test_dict_get_cached(client, db_session, run):
+    """
+           Повторное чтение словаря из кэша: читается только его версия,
+           а любая запись в справочник меняет версию и ключ кэша
+    """
+    response = client.get("/api/dictionary/type")
+    assert len(response.json().get('type')) == 3
+    with query_budget(1):
+        response = client.get("/api/dictionary/type")
+    assert len(response.json().get('type')) == 3
+
+    db_session.add(models.Type(name='bypass'))
+    run(db_session.commit())
+    response = client.get("/api/dictionary/type")
+    assert len(response.json().get('type')) == 4
+
+    client.post("/api/dictionary/type", json={"name": "test"})
+    response = client.get("/api/dictionary/type")
+    assert len(response.json().get('type')) == 5
+
+
 def test_dict_put(client):
     """
            Изменение записи в словарях
@@ -331,6 +678,7 @@ def test_coins_put_superuser(client):
                           json=request_data)
     assert response.status_code == 200
     assert response.json().get('description') == "test"
+    assert response.json().get('type') == {'name': 'бумажные', 'id': 2}
 
 
 def test_coins_get_user(client):
@@ -356,6 +704,20 @@ def test_coins_get_user(client):
     assert response.json().get('results') == 1
 
 
+def test_coins_get_user_promoted(client, db_session, run):
+    """Изменение прав пользователя сбрасывает закэшированные данные"""
+    cookies = get_cookies_user(client)
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json().get('results') == 0
+
+    user = run(db_session.scalar(select(models.User).where(
+        models.User.username == 'test')))
+    user.is_superuser = True
+    run(db_session.commit())
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json().get('results') == 3
+
+
 def test_coins_put_user_ok(client):
     """Изменение своих монеток как пользователь"""
     cookies = get_cookies_user(client)
@@ -402,6 +764,33 @@ def test_coins_put_user_fobbiden(client):
     assert response.status_code == 403
 
 
+def test_coins_put_user_keeps_owner(client, db_session, run):
+    """Пользователь не может передать свою монетку другому"""
+    cookies = get_cookies_user(client)
+    request_data = {
+        "description": "money",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    response = client.post("/api/coins", json=request_data, cookies=cookies)
+    owner_id = response.json()['user']['id']
+    other_id = run(db_session.scalar(select(models.Coins.user_id).where(
+        models.Coins.id == 1)))
+    assert other_id != owner_id
+    response = client.put("/api/coins/4", json=dict(
+        request_data, description="test", user_id=other_id), cookies=cookies)
+    assert response.status_code == 200
+    assert response.json()['description'] == "test"
+    assert response.json()['user']['id'] == owner_id
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json().get('results') == 1
+
+
 def test_coins_delete_user_ok(client):
     """Удаление своих монеток как пользователь"""
     cookies = get_cookies_user(client)
@@ -425,3 +814,779 @@ def test_coins_delete_user_forbbiden(client):
     cookies = get_cookies_user(client)
     response = client.delete("/api/coins/1", cookies=cookies)
     assert response.status_code == 403
+
+
+def test_coins_put_delete_not_found(client):
+    """Изменение и удаление несуществующей монетки"""
+    cookies = get_cookies_user(client)
+    request_data = {
+        "description": "test",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    response = client.put("/api/coins/100", json=request_data,
+                          cookies=cookies)
+    assert response.status_code == 404
+    response = client.delete("/api/coins/100", cookies=cookies)
+    assert response.status_code == 404
+
+
+def test_coins_get_paginated(client):
+    """Постраничное получение монеток по курсору"""
+    cookies = get_cookies_superuser(client)
+    response = client.get("/api/coins?limit=2", cookies=cookies)
+    assert response.status_code == 200
+    assert response.json().get('results') == 2
+    next_cursor = response.json().get('next_cursor')
+    assert next_cursor
+    first_page_ids = [coin['id'] for coin in response.json()['coins']]
+
+    response = client.get(f"/api/coins?limit=2&after={next_cursor}",
+                          cookies=cookies)
+    assert response.status_code == 200
+    assert response.json().get('results') == 1
+    assert response.json().get('next_cursor') is None
+    assert response.json()['coins'][0]['id'] not in first_page_ids
+
+
+def test_coins_get_invalid_cursor(client):
+    """Получение монеток с некорректным курсором"""
+    response = client.get("/api/coins?after=not-a-cursor",
+                          cookies=get_cookies_superuser(client))
+    assert response.status_code == 400
+
+
+def test_coins_batch_create(client):
+    """Пакетное создание монеток с ошибкой в одном элементе"""
+    cookies = get_cookies_user(client)
+    coin = {
+        "description": "test",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    request_data = [coin, dict(coin, type_id=100), coin]
+    response = client.post("/api/coins/batch", json=request_data,
+                           cookies=cookies)
+    assert response.status_code == 200
+    results = response.json().get('results')
+    assert [item['status'] for item in results] == ['created', 'error',
+                                                    'created']
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json().get('results') == 2
+
+
+def test_coins_batch_update(client):
+    """Пакетное изменение своих, чужих и несуществующих монеток"""
+    cookies = get_cookies_user(client)
+    coin = {
+        "description": "money",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    client.post("/api/coins", json=coin, cookies=cookies)
+    request_data = [dict(coin, id=4, description="test"),
+                    dict(coin, id=1, description="test"),
+                    dict(coin, id=100, description="test")]
+    response = client.patch("/api/coins/batch", json=request_data,
+                            cookies=cookies)
+    assert response.status_code == 200
+    results = response.json().get('results')
+    assert [item['status'] for item in results] == ['updated', 'error',
+                                                    'error']
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json()['coins'][0]['description'] == 'test'
+
+
+def stale_reference_check(monkeypatch, name):
+    """
+    Первая проверка ссылок не видит ошибок, а первая запись пакета
+    падает, как если бы запись справочника удалили между ними
+    """
+    check = coin_router.get_missing_references
+    write = getattr(coin_router, name)
+    calls = []
+
+    async def stale_check(db, coins):
+        calls.append('check')
+        return {} if len(calls) == 1 else await check(db, coins)
+
+    async def write_after_delete(db, *args):
+        if calls == ['check']:
+            calls.append('write')
+            raise IntegrityError('INSERT', None, Exception('type_id'))
+        return await write(db, *args)
+
+    monkeypatch.setattr(coin_router, 'get_missing_references', stale_check)
+    monkeypatch.setattr(coin_router, name, write_after_delete)
+    return calls
+
+
+def test_coins_batch_reference_deleted(client, monkeypatch):
+    """Пакет, запись которого упала на внешнем ключе, проверяется заново"""
+    calls = stale_reference_check(monkeypatch, 'insert_batch')
+    client.cookies = get_cookies_user(client)
+    request_data = [COIN, dict(COIN, type_id=100), COIN]
+    response = client.post("/api/coins/batch", json=request_data)
+    assert response.status_code == 200
+    results = response.json().get('results')
+    assert [item['status'] for item in results] == ['created', 'error',
+                                                    'created']
+    assert results[1]['detail'] == 'No type_id with this id: 100'
+    assert calls == ['check', 'write', 'check']
+    assert client.get("/api/coins").json()['results'] == 2
+
+    calls = stale_reference_check(monkeypatch, 'update_batch')
+    request_data = [dict(COIN, id=results[0]['id'], description='test'),
+                    dict(COIN, id=results[2]['id'], type_id=100)]
+    response = client.patch("/api/coins/batch", json=request_data)
+    assert response.status_code == 200
+    results = response.json().get('results')
+    assert [item['status'] for item in results] == ['updated', 'error']
+    assert calls == ['check', 'write', 'check']
+    coins = client.get("/api/coins").json()['coins']
+    assert sorted(coin['description'] for coin in coins) == ['money',
+                                                             'test']
+
+
+def test_coins_batch_delete(client):
+    """Пакетное удаление монеток как администратор"""
+    cookies = get_cookies_superuser(client)
+    response = client.request("DELETE", "/api/coins/batch",
+                              json={"ids": [1, 2, 100]}, cookies=cookies)
+    assert response.status_code == 200
+    results = response.json().get('results')
+    assert [item['status'] for item in results] == ['deleted', 'deleted',
+                                                    'error']
+    response = client.get("/api/coins", cookies=cookies)
+    assert response.json().get('results') == 1
+
+
+def test_coins_export_ndjson_superuser(client):
+    """Выгрузка всех монеток в NDJSON как администратор"""
+    response = client.get("/api/coins/export",
+                          cookies=get_cookies_superuser(client))
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0])['description'] == 'золотая монета'
+
+
+def test_coins_export_csv_user(client):
+    """Выгрузка только своих монеток в CSV как пользователь"""
+    response = client.get("/api/coins/export?format=csv",
+                          cookies=get_cookies_user(client))
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith('id,description,type_id,type')
+
+
+def test_coins_import_csv(client):
+    """Импорт монеток из CSV с отчетом об ошибочных строках"""
+    cookies = get_cookies_user(client)
+    content = (
+        "description,type_id,currency_id,nominal_value,md_id,state_id,"
+        "year,serial_number\n"
+        "\"первая,\nмонета\",2,2,4000,2,2,1900,1122\n"
+        "вторая,100,2,4000,2,2,1900,1122\n"
+        "третья,x,2,4000,2,2,1900,1122\n"
+        "четвертая,1,1,10,1,1,1910,77\n"
+    )
+    response = client.post("/api/coins/import?format=csv",
+                           content=content.encode(), cookies=cookies)
+    assert response.status_code == 200
+    assert response.json().get('imported') == 2
+    assert [error['row'] for error in response.json()['errors']] == [2, 3]
+    response = client.get("/api/coins", cookies=cookies)
+    coins = response.json()['coins']
+    assert [coin['description'] for coin in coins] == ['первая,\nмонета',
+                                                      'четвертая']
+
+
+def test_coins_import_csv_quotes(client, monkeypatch):
+    """
+    Кавычка внутри значения не склеивает строки, а незакрытая кавычка
+    теряет только свою строку; в ответе не больше заданного числа ошибок
+    """
+    monkeypatch.setattr(settings, "COINS_IMPORT_MAX_ERRORS", 1)
+    client.cookies = get_cookies_user(client)
+    content = (
+        "description,type_id,currency_id,nominal_value,md_id,state_id,"
+        "year,serial_number\n"
+        "5\" coin,1,1,10,1,1,1910,77\n"
+        "\"\"\"в кавычках\"\"\",1,1,10,1,1,1910,77\n"
+        "\"незакрытая,1,1,10,1,1,1910,77\n"
+        "вторая,x,2,4000,2,2,1900,1122\n"
+        "последняя,1,1,10,1,1,1910,77\n"
+    )
+    response = client.post("/api/coins/import?format=csv",
+                           content=content.encode())
+    assert response.status_code == 200
+    assert response.json().get('imported') == 3
+    assert response.json().get('failed') == 2
+    assert response.json().get('errors') == [
+        {'row': 3, 'detail': 'Unterminated quoted field'}]
+    coins = client.get("/api/coins").json()['coins']
+    assert [coin['description'] for coin in coins] == [
+        '5" coin', '"в кавычках"', 'последняя']
+
+
+def test_coins_import_ndjson(client):
+    """Импорт выгруженных монеток из NDJSON"""
+    cookies = get_cookies_superuser(client)
+    exported = client.get("/api/coins/export", cookies=cookies)
+    content = exported.content + b"not json\n"
+    response = client.post("/api/coins/import", content=content,
+                           cookies=cookies)
+    assert response.status_code == 200
+    assert response.json().get('imported') == 3
+    assert response.json().get('failed') == 1
+
+
+def test_coins_import_reference_deleted(client, monkeypatch):
+    """
+    Запись справочника удалили после проверки ссылок: пачка не роняет
+    импорт, а проверяется заново, и строка с ней попадает в ошибки
+    """
+    stale_reference_check(monkeypatch, 'insert_coins')
+    client.cookies = get_cookies_user(client)
+    content = '\n'.join(json.dumps(dict(COIN, type_id=type_id))
+                        for type_id in (1, 999, 2))
+    response = client.post("/api/coins/import", content=content.encode())
+    assert response.status_code == 200
+    assert response.json() == {
+        'status': 'success', 'imported': 2, 'failed': 1,
+        'errors': [{'row': 2, 'detail': 'No type_id with this id: 999'}]}
+    assert client.get("/api/coins").json()['results'] == 2
+
+
+def test_hot_queries_use_indexes(db_session, run):
+    """Частые запросы не должны приводить к полному просмотру таблиц"""
+    user = Principal(id=2, is_superuser=False)
+    admin = Principal(id=1, is_superuser=True)
+    coins_page = coin_serializer.select()
+    queries = {
+        'user coins first page': filter_visible(coins_page, user).order_by(
+            models.Coins.id).limit(51),
+        'user coins next page': filter_visible(coins_page, user).where(
+            models.Coins.id > 1).order_by(models.Coins.id).limit(51),
+        'admin coins next page': filter_visible(coins_page, admin).where(
+            models.Coins.id > 1).order_by(models.Coins.id).limit(51),
+        'coin by id': select(models.Coins).where(models.Coins.id == 1),
+        'coins by type': select(models.Coins.id).where(
+            models.Coins.type_id == 1),
+        'coins by currency': select(models.Coins.id).where(
+            models.Coins.currency_id == 1),
+        'coins by md': select(models.Coins.id).where(
+            models.Coins.md_id == 1),
+        'coins by state': select(models.Coins.id).where(
+            models.Coins.state_id == 1),
+        'user by id': select(models.User).where(models.User.id == 1),
+        'user by username': select(models.User).where(
+            models.User.username == 'admin'),
+    }
+    for name, query in queries.items():
+        sql = query.compile(dialect=async_engine.dialect,
+                            compile_kwargs={'literal_binds': True})
+        plan = run(db_session.execute(
+            text(f'EXPLAIN QUERY PLAN {sql}'))).all()
+        scans = [row.detail for row in plan if row.detail.startswith('SCAN')]
+        assert not scans, f'{name}: {scans}'
+
+
+def test_coins_get_filtered(client):
+    """Отбор монеток по справочникам, году и серийному номеру"""
+    cookies = get_cookies_superuser(client)
+    response = client.get("/api/coins?type_id=2&state_id=2",
+                          cookies=cookies)
+    assert response.json().get('results') == 2
+    response = client.get("/api/coins?year_from=1901&year_to=2000",
+                          cookies=cookies)
+    assert response.json().get('results') == 0
+    response = client.get("/api/coins?serial_number=11", cookies=cookies)
+    assert response.json().get('results') == 3
+    response = client.get("/api/coins?serial_number=2", cookies=cookies)
+    assert response.json().get('results') == 0
+
+
+def test_coins_get_filtered_by_year(client):
+    """Год сравнивается числом, годы не числом в диапазон не попадают"""
+    client.cookies = get_cookies_user(client)
+    for year in ('500', '1500', '1500-е'):
+        client.post("/api/coins", json=dict(COIN, year=year))
+    response = client.get("/api/coins?year_from=1000")
+    assert [coin['year'] for coin in response.json()['coins']] == ['1500']
+    response = client.get("/api/coins?year_to=999")
+    assert [coin['year'] for coin in response.json()['coins']] == ['500']
+    assert client.get("/api/coins?year_from=x").status_code == 422
+
+
+def test_coins_get_search(client):
+    """Полнотекстовый поиск по описанию монеток"""
+    cookies = get_cookies_superuser(client)
+    response = client.get("/api/coins?search=золотая", cookies=cookies)
+    assert response.json().get('results') == 1
+    assert response.json()['coins'][0]['description'] == 'золотая монета'
+
+    request_data = {
+        "description": "серебряная монета",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    client.post("/api/coins", json=request_data, cookies=cookies)
+    response = client.get("/api/coins?search=монета", cookies=cookies)
+    assert response.json().get('results') == 2
+    client.delete("/api/coins/1", cookies=cookies)
+    response = client.get("/api/coins?search=монета", cookies=cookies)
+    assert response.json().get('results') == 1
+
+
+def test_coins_stats(client, db_session, run):
+    """Статистика коллекции пересчитывается при изменении монеток"""
+    cookies = get_cookies_user(client)
+    request_data = {
+        "description": "test",
+        "type_id": 2,
+        "currency_id": 2,
+        "nominal_value": "4000",
+        "md_id": 2,
+        "state_id": 2,
+        "year": "1900",
+        "serial_number": "1122",
+    }
+    client.post("/api/coins", json=request_data, cookies=cookies)
+    client.post("/api/coins/batch", json=[request_data, request_data],
+                cookies=cookies)
+    client.put("/api/coins/4", json=dict(request_data, state_id=1,
+                                         year="1901"), cookies=cookies)
+    client.delete("/api/coins/5", cookies=cookies)
+
+    response = client.get("/api/coins/stats", cookies=cookies)
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats['total'] == 2
+    assert stats['type'] == [{'id': 2, 'count': 2}]
+    assert sorted(stats['state'], key=lambda item: item['id']) == [
+        {'id': 1, 'count': 1}, {'id': 2, 'count': 1}]
+    assert sorted(item['year'] for item in stats['year']) == ['1900',
+                                                               '1901']
+
+    client.delete("/api/coins/4", cookies=cookies)
+    assert client.get("/api/coins/stats",
+                      cookies=cookies).json()['state'] == [
+        {'id': 2, 'count': 1}]
+    # Обнулившиеся счетчики удаляются
+    for counters in (models.CoinStats, models.CoinStatsTotal):
+        zero = run(db_session.scalar(select(func.count()).where(
+            counters.count <= 0)))
+        assert zero == 0
+    assert run(db_session.scalar(select(func.count()).where(
+        models.CoinStats.value == '1901'))) == 0
+
+
+def test_coins_stats_superuser(client):
+    """Статистика по всем монеткам как администратор"""
+    response = client.get("/api/coins/stats",
+                          cookies=get_cookies_superuser(client))
+    assert response.status_code == 200
+    assert response.json()['total'] == 3
+    cookies = get_cookies_user(client)
+    client.post("/api/coins", json=dict(COIN, type_id=1), cookies=cookies)
+    stats = client.get("/api/coins/stats",
+                       cookies=get_cookies_superuser(client)).json()
+    assert stats['total'] == 4
+    assert {'id': 1, 'count': 2} in stats['type']
+
+
+@pytest.fixture
+def postgres_connection():
+    """
+    Соединение с TEST_POSTGRES_URL: схема создается в отдельной схеме
+    внутри транзакции, которая откатывается после теста
+    """
+    if not TEST_POSTGRES_URL:
+        pytest.skip('TEST_POSTGRES_URL is not set')
+    engine = create_engine(TEST_POSTGRES_URL)
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(text('CREATE SCHEMA triggers_test'))
+        connection.execute(text('SET LOCAL search_path = triggers_test'))
+        Base.metadata.create_all(connection)
+        connection.execute(text(
+            'INSERT INTO "user" (id, username) '
+            "SELECT id, 'user' || id FROM generate_series(1, 20) AS id"))
+        yield connection
+        transaction.rollback()
+    engine.dispose()
+
+
+def table_writes(connection, table):
+    """Число вставленных и обновленных строк таблицы в этой транзакции"""
+    return connection.execute(text(
+        "SELECT n_tup_ins + n_tup_upd FROM pg_stat_xact_user_tables "
+        "WHERE schemaname = 'triggers_test' AND relname = :table"),
+        {'table': table}).scalar()
+
+
+@pytest.mark.parametrize('size', [1000, 10000])
+def test_postgres_stats_written_per_statement(postgres_connection, size):
+    """
+    Массовая вставка меняет каждую строку счетчиков один раз за оператор,
+    а не на каждую монетку: иначе время загрузки растет квадратично
+    """
+    postgres_connection.execute(text(
+        f'INSERT INTO "{models.Coins.__tablename__}" (year, user_id) '
+        f"SELECT CAST(number % 50 AS TEXT), number % 20 + 1 "
+        f"FROM generate_series(1, {size}) AS number"))
+    for table in ('coin_stats', 'coin_stats_total'):
+        rows, total = postgres_connection.execute(text(
+            f"SELECT count(*), sum(count) FILTER (WHERE dimension = 'year') "
+            f"FROM {table}")).one()
+        assert total == size
+        assert table_writes(postgres_connection, table) == rows
+
+    postgres_connection.execute(text(
+        f'UPDATE "{models.Coins.__tablename__}" SET year = \'x\' '
+        f'WHERE user_id = 2'))
+    assert postgres_connection.execute(text(
+        "SELECT count, (SELECT count(*) FROM coin_stats WHERE user_id = 2 "
+        "AND dimension = 'year') FROM coin_stats_total "
+        "WHERE slot = 2 AND dimension = 'year' AND value = 'x'")).one() == (
+        size // 20, 1)
+    postgres_connection.execute(text(
+        f'DELETE FROM "{models.Coins.__tablename__}" WHERE user_id = 1'))
+    remaining = postgres_connection.execute(text(
+        "SELECT sum(count) FROM coin_stats_total "
+        "WHERE dimension = 'year'")).scalar()
+    assert remaining == size - size // 20
+    assert not postgres_connection.execute(text(
+        'SELECT 1 FROM coin_stats WHERE user_id = 1')).first()
+
+
+def test_postgres_versions_bumped_per_statement(postgres_connection):
+    """
+    Версии коллекций меняются один раз за оператор для каждого владельца и
+    слота, а не на каждую монетку
+    """
+    coins = f'"{models.Coins.__tablename__}"'
+    postgres_connection.execute(text(
+        f"INSERT INTO {coins} (year, user_id) SELECT '1900', number % 20 + 1 "
+        f"FROM generate_series(1, 5000) AS number"))
+    postgres_connection.execute(text(
+        f"UPDATE {coins} SET year = '1901' WHERE user_id IN (1, 17)"))
+    versions = dict(postgres_connection.execute(text(
+        "SELECT collection || part, version FROM collection_versions")).all())
+    assert len(versions) == 20 + models.VERSION_SLOTS
+    assert versions['coins1'] == versions['coins17'] == 2
+    assert versions['coins2'] == 1
+    assert versions['coins_all1'] == 2
+    assert table_writes(postgres_connection, 'collection_versions') == len(
+        versions) + 3
+
+
+def test_health_db_pool(client):
+    """Статистика пула соединений"""
+    response = client.get("/health/db-pool")
+    assert response.status_code == 200
+    assert response.json().get('size') == settings.DB_POOL_SIZE
+    assert {'checked_out', 'overflow', 'wait_time_max'} <= set(
+        response.json())
+
+
+def test_metrics(client):
+    """Метрики запросов с шаблоном маршрута и числом SQL-запросов"""
+    metrics_app = FastAPI()
+    metrics_app.include_router(dictionary.router, prefix='/api/dictionary')
+    metrics_app.dependency_overrides = app.dependency_overrides
+    metrics.install(metrics_app)
+    with TestClient(metrics_app) as metrics_client:
+        metrics_client.put("/api/dictionary/type/1", json={"name": "test"})
+        metrics_client.get("/api/nothing")
+        response = metrics_client.get("/metrics")
+    assert response.status_code == 200
+    labels = 'method="PUT",route="/api/dictionary/type/{id}"'
+    assert f'http_responses_total{{{labels},status="200"}}' in response.text
+    assert 'route="unmatched",status="404"' in response.text
+    assert 'http_requests_in_flight{' + labels + '} 0' in response.text
+    statements = next(
+        line for line in response.text.splitlines()
+        if line.startswith('http_request_sql_statements_sum{' + labels))
+    assert float(statements.split()[-1]) > 0
+
+
+COIN = {
+    "description": "money",
+    "type_id": 2,
+    "currency_id": 2,
+    "nominal_value": "4000",
+    "md_id": 2,
+    "state_id": 2,
+    "year": "1900",
+    "serial_number": "1122",
+}
+
+
+@pytest.mark.parametrize("method,url,json_data,max_queries", [
+    ("get", "/api/coins", None, 3),
+    ("get", f"/api/coins?limit={settings.COINS_PAGE_SIZE_MAX}", None, 3),
+    ("get", "/api/coins?type_id=1&search=coin", None, 3),
+    ("get", "/api/coins/stats", None, 2),
+    ("get", "/api/coins/export", None, 2),
+    ("put", "/api/coins/1", COIN, 3),
+    ("delete", "/api/coins/2", None, 2),
+    ("patch", "/api/coins/batch",
+     [dict(COIN, id=id) for id in range(1, 101)], 4),
+    ("delete", "/api/coins/batch", {"ids": list(range(1, 101))}, 3),
+    ("get", "/api/dictionary/type", None, 2),
+])
+def test_query_budget(client, large_db, method, url, json_data,
+                      max_queries):
+    """Число SQL-запросов эндпоинта не зависит от числа монеток"""
+    client.cookies = get_cookies_superuser(client)
+    with query_budget(max_queries):
+        response = client.request(method, url, json=json_data)
+    assert response.is_success
+
+
+def test_generate_coins_deterministic_and_skewed():
+    """Генератор выдает одинаковые пачки при одном seed и перекос владельцев"""
+    args = (10000, list(range(1, 101)), [[1, 2, 3]] * 4)
+    batches = list(iter_coin_batches(*args, skew=1.0, seed=1,
+                                     batch_size=3000))
+    assert [len(batch) for batch in batches] == [3000, 3000, 3000, 1000]
+    assert batches == list(iter_coin_batches(*args, skew=1.0, seed=1,
+                                             batch_size=3000))
+    owners = [coin['user_id'] for batch in batches for coin in batch]
+    assert owners.count(1) > 10 * owners.count(100)
+    assert {coin['type_id'] for coin in batches[0]} == {1, 2, 3}
+
+
+def test_generate_rebuild_bumps_versions(db_connection, run):
+    """
+    Загрузка со снятыми триггерами меняет версии монеток и счетчики после
+    восстановления триггеров: ETag, выданные до загрузки, недействительны
+    """
+    versions = models.CollectionVersion
+
+    def load(connection):
+        def read():
+            return dict(connection.execute(
+                select(versions.collection, versions.version).where(
+                    versions.part == 2)).all())
+
+        before = read()
+        drop_coin_indexes(connection)
+        connection.execute(insert(models.Coins), [
+            dict(COIN, type_id=1, user_id=2), dict(COIN, user_id=2)])
+        assert read() == before
+        create_coin_indexes(connection)
+        return before, read()
+
+    before, after = run(db_connection.run_sync(load))
+    for collection in ('coins', 'coins_all'):
+        assert after[collection] == before.get(collection, 0) + 1
+    total = run(db_connection.scalar(select(func.sum(
+        models.CoinStats.count)).where(models.CoinStats.user_id == 2,
+                                       models.CoinStats.dimension == 'type')))
+    coins = run(db_connection.scalar(select(func.count()).where(
+        models.Coins.user_id == 2)))
+    assert total == coins
+
+
+def test_coins_get_matches_schema(client):
+    """Быстрая сериализация списка дает ту же форму, что и схема ListCoins"""
+    response = client.get("/api/coins", cookies=get_cookies_superuser(client))
+    assert response.status_code == 200
+    data = response.json()
+    assert schemas.ListCoins.parse_obj(data).dict() == data
+    assert data['coins'][0]['type'] == {'name': 'монеты', 'id': 1}
+
+
+def test_coins_get_not_modified(client):
+    """Повторный запрос с ETag без изменений монеток получает 304"""
+    cookies = get_cookies_user(client)
+    client.cookies = cookies
+    response = client.get("/api/coins")
+    etag = response.headers['etag']
+    response = client.get("/api/coins", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    response = client.get("/api/coins?limit=1",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    client.post("/api/coins", json=COIN)
+    response = client.get("/api/coins", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json().get('results') == 1
+    etag = response.headers['etag']
+    client.put("/api/dictionary/type/2", json={"name": "test"})
+    response = client.get("/api/coins", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()['coins'][0]['type']['name'] == 'test'
+
+
+def test_coins_get_cached(client):
+    """Повторный запрос списка отдается из кэша по ETag без чтения монеток"""
+    client.cookies = get_cookies_user(client)
+    client.post("/api/coins", json=COIN)
+    response = client.get("/api/coins")
+    with query_budget(2):
+        cached = client.get("/api/coins")
+    assert cached.content == response.content
+    assert cached.headers['etag'] == response.headers['etag']
+
+
+def test_dict_get_not_modified(client):
+    """Повторный запрос справочника с ETag получает 304 до его изменения"""
+    response = client.get("/api/dictionary/md")
+    etag = response.headers['etag']
+    response = client.get("/api/dictionary/md",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    client.post("/api/dictionary/md", json={"name": "test"})
+    response = client.get("/api/dictionary/md",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json().get('md')) == 4
+
+
+def test_dict_cache_keyed_by_version(client, db_session, monkeypatch):
+    """
+    Список, прочитанный до записи в справочник и попавший в кэш после
+    нее, не выдается под новым ETag
+    """
+    set_cache = dictionary_cache.set
+
+    async def set_after_write(key, value):
+        await db_session.execute(insert(models.State), [{'name': 'еще'}])
+        await db_session.commit()
+        await set_cache(key, value)
+
+    monkeypatch.setattr(dictionary_cache, 'set', set_after_write)
+    assert len(client.get("/api/dictionary/state").json()['state']) == 3
+    monkeypatch.undo()
+    assert len(client.get("/api/dictionary/state").json()['state']) == 4
+
+
+def cache_workers(backend, tmp_path):
+    """Два экземпляра кэша с общим хранилищем, как в двух воркерах"""
+    if backend == 'sqlite':
+        path = str(tmp_path / 'cache.db')
+        return (SQLiteCache(path, 'test', ttl=60),
+                SQLiteCache(path, 'test', ttl=60))
+    server = fakeredis.FakeServer()
+    return tuple(RedisCache(fakeredis.aioredis.FakeRedis(server=server),
+                            'test', ttl=60, local_ttl=60) for _ in range(2))
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite', 'redis'])
+def test_cache_backend(backend, tmp_path, run):
+    if backend == 'memory':
+        cache = MemoryCache(maxsize=2, ttl=60)
+    else:
+        cache = cache_workers(backend, tmp_path)[0]
+    run(cache.set(1, {'id': 1}))
+    run(cache.set('type', ['"etag"', [{'id': 1}]]))
+    assert run(cache.get(1)) == {'id': 1}
+    assert run(cache.get('type')) == ['"etag"', [{'id': 1}]]
+    assert run(cache.get('1')) is None
+    run(cache.delete(1))
+    assert run(cache.get(1, 'missing')) == 'missing'
+    run(cache.clear())
+    assert run(cache.get('type')) is None
+
+
+def test_cache_max_bytes():
+    """Тела ответов вытесняются по суммарному размеру, а не только числу"""
+    cache = TTLCache(maxsize=100, ttl=60, maxbytes=10)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    cache.set('c', b'1234')
+    assert cache.get('a') is None and cache.size == 8
+    cache.set('b', b'12')
+    assert cache.size == 6
+    cache.set('big', b'x' * 11)
+    assert cache.get('big') is None and cache.get('c') == b'1234'
+    cache.delete('c')
+    assert cache.size == 2
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'redis'])
+def test_cache_codecs(backend, tmp_path, run):
+    """В общих хранилищах значения хранятся как данные, а не pickle"""
+    cache = cache_workers(backend, tmp_path)[0]
+    cache.codec = PRINCIPAL_CODEC
+    run(cache.set(1, Principal(1, True)))
+    assert run(cache.get(1)) == Principal(1, True)
+    cache.codec = BYTES_CODEC
+    run(cache.set('page', b'{"coins": []}'))
+    assert run(cache.get('page')) == b'{"coins": []}'
+
+
+def test_cache_file_private(tmp_path, run):
+    """Файл кэша создается только для владельца, доступный другим - нет"""
+    path = tmp_path / 'cache.db'
+    run(SQLiteCache(str(path), 'test').set('key', 'value'))
+    assert path.stat().st_mode & 0o777 == 0o600
+    shared = tmp_path / 'shared.db'
+    shared.touch()
+    shared.chmod(0o666)
+    with pytest.raises(PermissionError):
+        run(SQLiteCache(str(shared), 'test').get('key'))
+    with pytest.raises(ValidationError):
+        Settings(CACHE_BACKEND='sqlite', CACHE_URL=None)
+
+
+def wait_for_missing(cache, key, run):
+    deadline = time.monotonic() + 5
+    while run(cache.get(key)) is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return run(cache.get(key)) is None
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'redis'])
+def test_cache_invalidation_reaches_workers(backend, tmp_path, run):
+    """Удаление в одном воркере видно в другом, даже с локальной копией"""
+    first, second = cache_workers(backend, tmp_path)
+    run(first.set('type', 'old'))
+    assert run(second.get('type')) == 'old'
+    run(first.delete('type'))
+    assert wait_for_missing(second, 'type', run)
+    run(second.set('type', 'new'))
+    assert run(first.get('type')) == 'new'
+    run(second.clear())
+    assert wait_for_missing(first, 'type', run)
+
+
+def test_cache_created_lazily(monkeypatch, tmp_path, run):
+    """Импорт не создает хранилище: оно появляется при первом обращении"""
+    path = tmp_path / 'cache.db'
+    monkeypatch.setattr(settings, 'CACHE_BACKEND', 'sqlite')
+    monkeypatch.setattr(settings, 'CACHE_URL', str(path))
+    cache = create_cache('test', 10, 60)
+    assert not path.exists()
+    run(cache.set('key', 'value'))
+    assert path.exists() and run(cache.get('key')) == 'value'